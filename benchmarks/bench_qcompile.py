@@ -0,0 +1,216 @@
+# Benchmarks for the compilers, router and circuit conversions
+#
+# Example:
+#   python benchmarks/bench_qcompile.py --sizes 10 1000 100000 --qbits 5 20 --output results.json
+#   python benchmarks/bench_qcompile.py --output new.json --baseline results.json
+#
+# Every benchmark is timed (best of --repeat runs), then run once more under tracemalloc
+# to record its peak memory. The results are written as json so runs can be compared,
+# with --baseline any benchmark which got slower than --tolerance times the baseline is
+# reported, and so is any benchmark whose time grows faster than n^--max-exponent with
+# the number of gates (eg. a pass which went quadratic again).
+from qcompile import comp_utils as utils
+from qcompile import qcomp
+from qcompile import schedule
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+
+# Circuits and topologies ----------------------------------------------------------------------------------
+
+
+def make_circuit(num_gates, num_qbits, seed=0):
+    """ returns a random GateIR with exactly num_gates gates """
+    depth = 2 * math.ceil(num_gates / max(num_qbits // 2, 1)) + 1  # plenty of layers, then cut it down
+    ir = utils.random_circ_ir(num_qbits, depth, seed=seed)
+    return utils.GateIR(ir.ops[:num_gates], ir.qbits[:num_gates], ir.params[:num_gates], num_qbits)
+
+
+def make_topology(name, num_qbits):
+    """ returns a dict (topology) for a 'ring', 'line' or 'grid' of num_qbits qbits """
+
+    if name == 'ring':
+        return {qbit: [(qbit - 1) % num_qbits, (qbit + 1) % num_qbits] for qbit in range(num_qbits)}
+
+    if name == 'line':
+        return {qbit: [nbr for nbr in (qbit - 1, qbit + 1) if 0 <= nbr < num_qbits] for qbit in range(num_qbits)}
+
+    if name == 'grid':  # as square as possible, the last row may be partially filled
+        width = math.ceil(math.sqrt(num_qbits))
+        topology = {}
+        for qbit in range(num_qbits):
+            row, col = divmod(qbit, width)
+            nbrs = [qbit - width, qbit + width] + ([qbit - 1] if col > 0 else []) + ([qbit + 1] if col < width - 1 else [])
+            topology[qbit] = [nbr for nbr in nbrs if 0 <= nbr < num_qbits]
+        return topology
+
+    raise ValueError("unknown topology '{}'".format(name))
+
+
+# Benchmarks -----------------------------------------------------------------------------------------------
+# Each benchmark is (setup, run): setup(ir, topology) prepares the input outside of the timed region
+# and run(input) is timed, it returns the output as a GateIR, gate_lst or qiskit circuit (or None).
+
+
+def _cz_star(ir, topology):
+    """ as many Cz gates as ir, all sharing qbit 0, so they form one long block of commuting gates """
+    return [('Cz', [0, 1 + index % (ir.num_qbits - 1)], []) for index in range(len(ir))]
+
+
+def _general_replace(gate_lst):
+    utils.general_replace(gate_lst, 'Cx', qcomp.cx_rule[1])
+    return gate_lst
+
+
+benchmarks = {
+    'read_circ': (lambda ir, topology: utils.write_circ(ir), lambda circ: utils.read_circ(circ)[0]),
+    'write_circ': (lambda ir, topology: (ir.to_gate_lst(), ir.num_qbits), lambda args: utils.write_circ(*args)),
+    'general_replace': (lambda ir, topology: ir.to_gate_lst(), _general_replace),
+    'simple_compiler': (lambda ir, topology: ir, qcomp.simple_compiler),
+    'compiler': (lambda ir, topology: ir, qcomp.compiler),
+    'circ_router': (lambda ir, topology: (qcomp.compiler(ir), topology), lambda args: qcomp.circ_router(*args)),
+    'layout_router': (lambda ir, topology: (qcomp.compiler(ir), topology),
+                      lambda args: qcomp.layout_router(*args)[0]),
+    'schedule': (lambda ir, topology: qcomp.compile_gates(ir.to_gate_lst()), schedule.schedule),
+    'schedule_cz': (_cz_star, schedule.schedule),
+}
+routing_benchmarks = ['circ_router', 'layout_router']
+
+
+def output_metrics(output, num_qbits):
+    """ gate counts and depth of a benchmark output """
+
+    if output is None:
+        return {}
+    if not isinstance(output, (utils.GateIR, list)):   # qiskit circuit
+        output = utils.read_circ_ir(output)
+    if isinstance(output, list):
+        output = utils.GateIR.from_gate_lst(output, num_qbits)
+
+    return {'out_gates': len(output), 'cz': output.count('Cz'), 'swaps': output.count('S'),
+            'depth': utils.circuit_depth(output, output.num_qbits)}
+
+
+def run_benchmark(name, num_gates, num_qbits, topology_name, repeat):
+    """ times a single benchmark and records its peak memory and output metrics """
+
+    setup, run = benchmarks[name]
+    ir = make_circuit(num_gates, num_qbits)
+    topology = make_topology(topology_name, num_qbits) if topology_name else None
+
+    best = float('inf')
+    output = None
+    for _ in range(repeat):
+        args = setup(ir, topology)
+        start = time.perf_counter()
+        output = run(args)
+        best = min(best, time.perf_counter() - start)
+
+    args = setup(ir, topology)
+    tracemalloc.start()
+    run(args)
+    peak_mem = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {'bench': name, 'num_gates': num_gates, 'num_qbits': num_qbits, 'topology': topology_name,
+              'time_s': best, 'peak_mem_bytes': peak_mem}
+    result.update(output_metrics(output, num_qbits))
+    return result
+
+
+# Comparisons ----------------------------------------------------------------------------------------------
+
+
+def _case(result):
+    return result['bench'], result['num_gates'], result['num_qbits'], result['topology']
+
+
+def compare(results, baseline, tolerance):
+    """ returns the results which are more than tolerance times slower than the baseline """
+
+    baseline = {_case(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get(_case(result))
+        if old is not None and old['time_s'] > 0 and result['time_s'] > tolerance * old['time_s']:
+            regressions.append((result, result['time_s'] / old['time_s']))
+    return regressions
+
+
+def scaling_exponents(results, min_gates=1000):
+    """ fits time ~ num_gates^k for each benchmark (over the sizes >= min_gates) and returns the k's """
+
+    series = {}
+    for result in results:
+        if result['num_gates'] >= min_gates and result['time_s'] > 0:
+            key = (result['bench'], result['num_qbits'], result['topology'])
+            series.setdefault(key, []).append((result['num_gates'], result['time_s']))
+
+    exponents = {}
+    for key, points in series.items():
+        if len(points) >= 2:
+            sizes, times = zip(*sorted(points))
+            exponents[key] = float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+    return exponents
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the qcompile compilers, router and conversions.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                        help='number of gates in the input circuits')
+    parser.add_argument('--qbits', type=int, nargs='+', default=[2, 5, 20, 100], help='number of qbits')
+    parser.add_argument('--topologies', nargs='+', default=['ring', 'line', 'grid'],
+                        help='topologies used by the routing benchmarks (ring, line, grid)')
+    parser.add_argument('--bench', nargs='+', default=list(benchmarks), choices=list(benchmarks),
+                        help='benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs (the best is kept)')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the json results')
+    parser.add_argument('--baseline', help='json results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown relative to the baseline')
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help='largest allowed growth exponent of time with the number of gates')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.bench:
+        topologies = args.topologies if name in routing_benchmarks else [None]
+        for topology_name in topologies:
+            for num_qbits in args.qbits:
+                for num_gates in args.sizes:
+                    result = run_benchmark(name, num_gates, num_qbits, topology_name, args.repeat)
+                    results.append(result)
+                    print('{bench:>16} {topology!s:>5} qbits={num_qbits:<4} gates={num_gates:<8} '
+                          'time={time_s:.4f}s mem={peak_mem_bytes:>11} out={out_gates} cz={cz} swaps={swaps} '
+                          'depth={depth}'.format(**result))
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(args.output, 'w') as file:
+        json.dump({'meta': meta, 'results': results}, file, indent=1)
+
+    failed = False
+    for (name, num_qbits, topology_name), exponent in sorted(scaling_exponents(results).items(), key=str):
+        if exponent > args.max_exponent:
+            failed = True
+            print('SCALING: {} (qbits={}, topology={}) grows like n^{:.2f}'.format(name, num_qbits,
+                                                                                 topology_name, exponent))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        for result, ratio in compare(results, baseline, args.tolerance):
+            failed = True
+            print('REGRESSION: {bench} (qbits={num_qbits}, gates={num_gates}, topology={topology}) '
+                  'is {ratio:.2f}x slower than the baseline'.format(ratio=ratio, **result))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+# Structural compile cache, re-uses compiled templates for circuits with the same shape
+from . import comp_utils as utils
+from . import qcomp
+from . import template
+from collections import OrderedDict
+import hashlib
+import os
+import numpy as np
+
+
+class CompileCache:
+    """
+    Caches compiled CircuitTemplates keyed on the structure of a circuit (its gates and
+    qbits, but not its angles), the compiler mode and the topology. Circuits which only
+    differ in their Rx / Ry / Rz angles (eg. a parameter sweep) are compiled once, every
+    other time the cached template is just re-bound with the new angles.
+
+    Templates are kept in memory in LRU order (at most maxsize of them). If a directory
+    is given, they are also written there as .npz files and read back on a memory miss.
+    The hits, disk_hits and misses counters can be used to size the cache.
+
+    Circuits with unbound qiskit Parameters are keyed on their parameter expressions as well
+    (see parameterized_key), and compile to a circuit in terms of the same Parameters.
+
+    Templates can't be fused (fuse_rotations needs numeric angles), so in 'compiler' mode
+    compile fuses each bound circuit (fuse=True), to match what the compiler gives. This
+    only evaluates the angles and fuses the runs found once per template, in one batch.
+    """
+
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()  # key --> CircuitTemplate, least recently used first
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def compile(self, circ, mode='compiler', topology=None, fuse=True):
+        """
+        Compiles (and optionally routes) a circuit, re-using the cached template if possible.
+
+        :param circ: qiskit.QuantumCircuit object (or a GateIR), it may have unbound Parameters
+        :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+        :param topology: optional dict, {qbit: [connected qbits]}, if given the circuit is also routed
+        :param fuse: bool, in 'compiler' mode, whether to fuse the single qbit gates of the bound circuit
+                     (False is faster, but leaves more gates than the compiler would)
+        :return: compiled_circ: new qiskit.QuantumCircuit object (or a GateIR)
+        """
+
+        if _has_parameters(circ):  # nothing to bind, write the template out in terms of the Parameters
+            compiled_template = self.get_template(circ, mode, topology)
+            return utils.write_circ(compiled_template.to_gate_lst(circ.parameters),
+                                    compiled_template.skeleton.num_qbits)
+
+        ir = circ if isinstance(circ, utils.GateIR) else utils.read_circ_ir(circ)
+        compiled_template = self.get_template(ir, mode, topology)
+        compiled_ir = compiled_template.bind(template.get_params(ir), fuse and mode == 'compiler')
+
+        if isinstance(circ, utils.GateIR):
+            return compiled_ir
+        return utils.write_circ(compiled_ir)
+
+    def get_template(self, circ, mode='compiler', topology=None):
+        """
+        Returns the CircuitTemplate for the structure of circ, compiling it on a miss.
+
+        :param circ: qiskit.QuantumCircuit object (or a GateIR)
+        :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+        :param topology: optional dict, {qbit: [connected qbits]}, if given the circuit is also routed
+        :return: CircuitTemplate
+        """
+
+        if _has_parameters(circ):  # read_circ_ir needs numeric angles
+            source, key = circ, parameterized_key(circ, mode, topology)
+        else:
+            source = circ if isinstance(circ, utils.GateIR) else utils.read_circ_ir(circ)
+            key = structure_key(source, mode, topology)
+
+        compiled = self._templates.get(key)
+        if compiled is not None:
+            self.hits += 1
+            self._templates.move_to_end(key)
+            return compiled
+
+        compiled = self._load(key)
+        if compiled is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            compiled = template.compile_template(source, mode, topology)
+            self._save(key, compiled)
+
+        self._templates[key] = compiled
+        if len(self._templates) > self.maxsize:  # evict the least recently used template
+            self._templates.popitem(last=False)
+
+        return compiled
+
+    def stats(self):
+        """ returns a dict with the hit / miss counters and the current size of the cache """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'size': len(self._templates), 'maxsize': self.maxsize}
+
+    def clear(self):
+        """ empties the in memory cache and resets the counters (files on disk are kept) """
+        self._templates.clear()
+        self.hits = self.disk_hits = self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _load(self, key):
+        if self.directory is None or not os.path.exists(self._path(key)):
+            return None
+        return template.CircuitTemplate.load(self._path(key))
+
+    def _save(self, key, compiled):
+        if self.directory is None:
+            return
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            compiled.save(file)
+        os.replace(tmp_path, self._path(key))  # so other processes never read a half written file
+
+
+def structure_key(ir, mode, topology=None):
+    """
+    A content address for the structure of a circuit: a hash of its opcodes, qbits,
+    number of qbits, the compiler mode and the topology (the angles are left out).
+
+    :param ir: GateIR
+    :param mode: str, the compiler mode
+    :param topology: optional dict, {qbit: [connected qbits]}
+    :return: str, hex digest
+    """
+
+    digest = hashlib.sha1()
+    digest.update(repr((mode, ir.num_qbits, len(ir))).encode())
+    digest.update(np.ascontiguousarray(ir.ops).tobytes())
+    digest.update(np.ascontiguousarray(ir.qbits).tobytes())
+    if topology is not None:
+        digest.update(repr(qcomp.topology_key(topology)).encode())
+    return digest.hexdigest()
+
+
+def parameterized_key(circ, mode, topology=None):
+    """
+    The structure_key of a circuit with unbound qiskit Parameters. Its template depends on the
+    parameter expressions (and numeric angles) as well, so the key includes them.
+
+    :param circ: qiskit.QuantumCircuit object
+    :param mode: str, the compiler mode
+    :param topology: optional dict, {qbit: [connected qbits]}
+    :return: str, hex digest
+    """
+
+    gate_lst, num_qbits = utils.read_circ(circ)
+    digest = hashlib.sha1()
+    digest.update(repr((mode, num_qbits, [param.name for param in circ.parameters])).encode())
+    digest.update(repr([(gate_str, qbit_lst, [str(param) for param in params])
+                        for gate_str, qbit_lst, params in gate_lst]).encode())
+    if topology is not None:
+        digest.update(repr(qcomp.topology_key(topology)).encode())
+    return digest.hexdigest()
+
+
+def _has_parameters(circ):
+    return not isinstance(circ, utils.GateIR) and len(circ.parameters) > 0
@@ -1,36 +1,175 @@
 # Main file for Quantum Compiler Utility Functions
-from qiskit import *
+from itertools import islice
+import importlib
 import numpy as np
 import random
 
 # Constants ------------------------------------------------------------------------------------------------
 
-# All of the 'basic' qiskit gate types
-Id = qiskit.circuit.library.standard_gates.i.IGate
-H = qiskit.circuit.library.standard_gates.h.HGate
-X = qiskit.circuit.library.standard_gates.x.XGate
-Y = qiskit.circuit.library.standard_gates.y.YGate
-Z = qiskit.circuit.library.standard_gates.z.ZGate
-Rx = qiskit.circuit.library.standard_gates.rx.RXGate
-Ry = qiskit.circuit.library.standard_gates.ry.RYGate
-Rz = qiskit.circuit.library.standard_gates.rz.RZGate
-Cx = qiskit.circuit.library.standard_gates.x.CXGate
-Cz = qiskit.circuit.library.standard_gates.z.CZGate
-S = qiskit.circuit.library.standard_gates.swap.SwapGate
-
-list_of_gates = [Id, H, X, Y, Z, Rx, Ry, Rz, Cx, Cz, S]  # storing the gate types in list
 gate_str_dict = {0: 'I', 1: 'H', 2: 'X', 3: 'Y', 4: 'Z', 5: 'Rx', 6: 'Ry', 7: 'Rz', 8: 'Cx', 9: 'Cz', 10: 'S'}
-gate_func_dict = {'I': qiskit.QuantumCircuit.id,  # A dict relating the gate (str) to its qiskit func call
-                  'H': qiskit.QuantumCircuit.h,   # I use this to create the final (compiled) qiskit circuit object
-                  'X': qiskit.QuantumCircuit.x,
-                  'Y': qiskit.QuantumCircuit.y,
-                  'Z': qiskit.QuantumCircuit.z,
-                  'Rx': qiskit.QuantumCircuit.rx,
-                  'Ry': qiskit.QuantumCircuit.ry,
-                  'Rz': qiskit.QuantumCircuit.rz,
-                  'Cx': qiskit.QuantumCircuit.cx,
-                  'Cz': qiskit.QuantumCircuit.cz,
-                  'S': qiskit.QuantumCircuit.swap}
+
+# All of the 'basic' qiskit gate types, as (name, module in qiskit.circuit.library.standard_gates, class)
+# in opcode order. qiskit is only imported the first time one of these (or list_of_gates, gate_type_dict,
+# gate_func_dict) is used, so working with gate_lst's and GateIR's never has to pay for importing it.
+qiskit_gate_types = [('Id', 'i', 'IGate'), ('H', 'h', 'HGate'), ('X', 'x', 'XGate'), ('Y', 'y', 'YGate'),
+                     ('Z', 'z', 'ZGate'), ('Rx', 'rx', 'RXGate'), ('Ry', 'ry', 'RYGate'), ('Rz', 'rz', 'RZGate'),
+                     ('Cx', 'x', 'CXGate'), ('Cz', 'z', 'CZGate'), ('S', 'swap', 'SwapGate')]
+qiskit_func_names = {'I': 'id', 'H': 'h', 'X': 'x', 'Y': 'y', 'Z': 'z', 'Rx': 'rx', 'Ry': 'ry', 'Rz': 'rz',
+                     'Cx': 'cx', 'Cz': 'cz', 'S': 'swap'}
+
+
+def _qiskit_tables():
+    """
+    Imports qiskit and builds the gate tables the first time it's called:
+    the gate types (Id, H, ..., S), list_of_gates (the gate types in opcode order),
+    gate_type_dict (gate type --> opcode) and gate_func_dict (gate (str) --> qiskit func call).
+
+    :return: dict, the module globals (which now include the tables)
+    """
+
+    tables = globals()
+    if 'list_of_gates' not in tables:
+        qiskit = importlib.import_module('qiskit')
+        for name, module, cls in qiskit_gate_types:
+            tables[name] = getattr(importlib.import_module('qiskit.circuit.library.standard_gates.' + module), cls)
+
+        tables['gate_func_dict'] = {gate_str: getattr(qiskit.QuantumCircuit, func_name)
+                                    for gate_str, func_name in qiskit_func_names.items()}
+        tables['gate_type_dict'] = {tables[name]: op for op, (name, module, cls) in enumerate(qiskit_gate_types)}
+        tables['qiskit'] = qiskit
+        tables['list_of_gates'] = [tables[name] for name, module, cls in qiskit_gate_types]
+    return tables
+
+
+_lazy_names = {'qiskit', 'list_of_gates', 'gate_type_dict', 'gate_func_dict'} | {gate[0] for gate in qiskit_gate_types}
+
+
+def __getattr__(name):
+    """ lazily provides the qiskit gate tables as module attributes (eg. comp_utils.list_of_gates) """
+    if name in _lazy_names:
+        return _qiskit_tables()[name]
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+gate_op_dict = {gate_str: op for op, gate_str in gate_str_dict.items()}  # gate (str) --> opcode used by GateIR
+
+# Gate IR --------------------------------------------------------------------------------------------------
+
+
+class GateIR:
+    """
+    A compact, array backed alternative to the gate_lst (a struct of arrays). Gate i is stored as
+    the opcode ops[i] (the keys of gate_str_dict), the qbit indicies qbits[i] (a fixed width of 2,
+    single qbit gates are padded with -1) and the parameter params[i] (nan if the gate has none).
+    This takes ~17 bytes per gate and allows numpy vectorized passes over the whole circuit.
+    """
+
+    __slots__ = ('ops', 'qbits', 'params', 'num_qbits')
+
+    def __init__(self, ops, qbits, params, num_qbits):
+        self.ops = np.asarray(ops, dtype=np.int8)
+        self.qbits = np.asarray(qbits, dtype=np.int32).reshape(-1, 2)
+        self.params = np.asarray(params, dtype=np.float64)
+        self.num_qbits = num_qbits
+
+    @classmethod
+    def from_gate_lst(cls, gate_lst, num_qbits):
+        """
+        Packs a gate_lst into a GateIR.
+
+        :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+        :param num_qbits: int, number of qbits in circuit
+        :return: GateIR
+        """
+
+        ops = [gate_op_dict[gate[0]] for gate in gate_lst]
+        qbits = [(gate[1][0], gate[1][1]) if len(gate[1]) > 1 else (gate[1][0], -1) for gate in gate_lst]
+        params = [gate[2][0] if gate[2] else np.nan for gate in gate_lst]
+        return cls(ops, np.array(qbits, dtype=np.int32).reshape(-1, 2), params, num_qbits)
+
+    def to_gate_lst(self):
+        """
+        Unpacks the GateIR into a gate_lst.
+
+        :return: gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+        """
+
+        return list(self)
+
+    def __iter__(self):
+        """ yields the gate tuples eg. ('gate_str', [qbits], [params]) one at a time """
+        for op, (qbit1, qbit2), param in zip(self.ops.tolist(), self.qbits.tolist(), self.params.tolist()):
+            qbit_lst = [qbit1] if qbit2 < 0 else [qbit1, qbit2]
+            parameter_lst = [] if param != param else [param]  # nan --> no parameter
+            yield gate_str_dict[op], qbit_lst, parameter_lst
+
+    def __len__(self):
+        return len(self.ops)
+
+    def mask(self, gate_str):
+        """ returns a bool array which is True wherever the gate 'gate_str' is applied """
+        return self.ops == gate_op_dict[gate_str]
+
+    def count(self, gate_str):
+        """ returns the number of 'gate_str' gates in the circuit """
+        return int(np.count_nonzero(self.mask(gate_str)))
+
+    def counts(self):
+        """ returns a dict {gate_str: count} over all of the gates in the circuit """
+        counts = np.bincount(self.ops, minlength=len(gate_str_dict))
+        return {gate_str_dict[op]: int(num) for op, num in enumerate(counts) if num}
+
+    @property
+    def nbytes(self):
+        return self.ops.nbytes + self.qbits.nbytes + self.params.nbytes
+
+
+class Angle:
+    """
+    A rotation angle which is a linear function of the parameters of a circuit:
+    const + sum(coeff * params[index] for index, coeff in terms.items()).
+    Using these as the params of a gate_lst lets the compiler track how every
+    output angle depends on the input angles (eg. when merging Rz gates).
+    """
+
+    __slots__ = ('const', 'terms')
+
+    def __init__(self, const=0.0, terms=None):
+        self.const = const
+        self.terms = terms if terms is not None else {}  # param index --> coeff
+
+    @classmethod
+    def param(cls, index):
+        """ the angle equal to the index-th parameter """
+        return cls(0.0, {index: 1.0})
+
+    def __add__(self, other):
+        if isinstance(other, Angle):
+            terms = dict(self.terms)
+            for index, coeff in other.terms.items():
+                terms[index] = terms.get(index, 0.0) + coeff
+            return Angle(self.const + other.const, terms)
+        return Angle(self.const + other, self.terms)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Angle(-self.const, {index: -coeff for index, coeff in self.terms.items()})
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, scalar):
+        return Angle(self.const * scalar, {index: coeff * scalar for index, coeff in self.terms.items()})
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        return 'Angle({}, {})'.format(self.const, self.terms)
+
 
 # Functions ------------------------------------------------------------------------------------------------
 
@@ -45,13 +184,14 @@ def read_circ(circ):
     :return: gate_lst, num_qbits: a list of tuples and an int
     """
 
+    gate_type_dict = _qiskit_tables()['gate_type_dict']
     gate_lst = []
     num_qbits = circ.num_qubits
 
     meta_data = circ.data              # read circuit meta data
     for element in meta_data:
         gate_type = type(element[0])                                 # read the gate type
-        gate_str = gate_str_dict[list_of_gates.index(gate_type)]     # determine the gate_str from its type
+        gate_str = gate_str_dict[gate_type_dict[gate_type]]          # determine the gate_str from its type
         qbit_lst = [qbit.index for qbit in element[1]]               # list of the qbit indicies that the gate acts on
         parameter_lst = element[0].params                            # list of parameters used by the gate
 
@@ -60,31 +200,78 @@ def read_circ(circ):
     return gate_lst, num_qbits
 
 
-def write_circ(gate_lst, num_qbits):
+def iter_circ(circ):
+    """
+    A lazy version of read_circ, yields the gate tuples of a qiskit circuit
+    one at a time rather than building the whole gate_lst.
+
+    :param circ: Qiskit QuantumCircuit object
+    :return: generator of tuples eg. ('gate_str', [qbits], [params])
+    """
+
+    gate_type_dict = _qiskit_tables()['gate_type_dict']
+    for element in circ.data:
+        gate_str = gate_str_dict[gate_type_dict[type(element[0])]]
+        yield gate_str, [qbit.index for qbit in element[1]], element[0].params
+
+
+def read_circ_ir(circ):
+    """
+    Takes a qiskit circuit and creates a GateIR (the array backed gate_lst)
+    directly from the circuit meta data.
+
+    :param circ: Qiskit QuantumCircuit object
+    :return: GateIR
+    """
+
+    gate_type_dict = _qiskit_tables()['gate_type_dict']
+    meta_data = circ.data
+    num_gates = len(meta_data)
+    ops = np.empty(num_gates, dtype=np.int8)
+    qbits = np.full((num_gates, 2), -1, dtype=np.int32)
+    params = np.full(num_gates, np.nan)
+
+    for i, element in enumerate(meta_data):
+        ops[i] = gate_type_dict[type(element[0])]                    # the opcode of the gate type
+        for j, qbit in enumerate(element[1]):
+            qbits[i, j] = qbit.index
+        if element[0].params:
+            params[i] = element[0].params[0]
+
+    return GateIR(ops, qbits, params, circ.num_qubits)
+
+
+def write_circ(gate_lst, num_qbits=None, schedule=None):
     """
     Takes a gate_lst and num_qbits to create a qiskit quantum circuit object.
     We assume that the circuit has the same number of qbits and bits, and we measure
     each qbit to its associated bit at the end of the circuit for simplicity
 
-    :param gate_lst: list of tuples, containing the meta_data of the circuit
-    :param num_qbits: int, number of qbits in circuit
+    :param gate_lst: list of tuples (or a GateIR), containing the meta_data of the circuit
+    :param num_qbits: int, number of qbits in circuit (optional for a GateIR)
+    :param schedule: optional str, 'asap' or 'alap', if given the gates are written out one layer
+                     (moment) at a time, commuting gates are reordered to shorten the circuit (see schedule.py)
     :return: circ: Qiskit QuantumCircuit object
     """
 
-    circ = qiskit.QuantumCircuit(num_qbits)  # construct an empty circuit with specified number of qbits
-    for gate in gate_lst:                    # iterate over list of gate information
-        gate_str = gate[0]
-        qbits = gate[1]
+    tables = _qiskit_tables()
+    list_of_gates = tables['list_of_gates']
 
-        if gate_str in ['Cx', 'Cz', 'S']:                         # apply Cx, Cz, or S gates
-            gate_func_dict[gate_str](circ, qbits[0], qbits[1])
+    if isinstance(gate_lst, GateIR):
+        if num_qbits is None:
+            num_qbits = gate_lst.num_qbits
 
-        elif gate_str in ['Rx', 'Ry', 'Rz']:                      # apply Rx, Ry or Rz gates with parameter
-            parameter = gate[2][0]
-            gate_func_dict[gate_str](circ, parameter, qbits)
+    if schedule is not None:
+        from .schedule import schedule as schedule_gates  # schedule.py imports this module
+        gate_lst = schedule_gates(gate_lst if isinstance(gate_lst, GateIR) else list(gate_lst), schedule)
 
-        else:                                                     # apply single qbit non parameterized gates
-            gate_func_dict[gate_str](circ, qbits)
+    circ = tables['qiskit'].QuantumCircuit(num_qbits)  # construct an empty circuit with specified number of qbits
+    qbit_objs = circ.qubits
+    append = circ._append  # append the instructions directly, skipping the per gate argument checks
+
+    for gate in gate_lst:                    # iterate over list of gate information
+        gate_type = list_of_gates[gate_op_dict[gate[0]]]
+        append(gate_type(*gate[2]), [qbit_objs[qbit] for qbit in gate[1]], [])
 
     return circ                   # return final circuit
 
@@ -104,76 +291,286 @@ def general_replace(gate_lst, gate_name, replacement_gates):
     a list of new parameters or a function which will be applied to the old parameters
     in order to determine the new parameters
 
-    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
     :param gate_name: a str, represents the quantum gate being applied
     :param replacement_gates: a list of tuples, ('new_gate_str', [new_qbits] or func, [params] or func)
     :return: None
     """
 
-    for index, gate in enumerate(gate_lst):  # iterate through the gate list
-        gate_str = gate[0]
+    if isinstance(gate_lst, GateIR):
+        new_ir = ir_replace(gate_lst, {gate_name: replacement_gates})
+        gate_lst.ops, gate_lst.qbits, gate_lst.params = new_ir.ops, new_ir.qbits, new_ir.params
+        return
 
-        if gate_str == gate_name:            # find and delete the gate tuple with name 'gate_name'
-            qbits = gate[1]
-            parms = gate[2]
-            del gate_lst[index]
+    gate_lst[:] = rule_replace(gate_lst, {gate_name: replacement_gates})  # single sweep, then swap the contents
+    return
 
-            for i, new_gate_tuple in enumerate(replacement_gates):  # replace it with the set of gates provided
-                replacement_gate_name = new_gate_tuple[0]
-                replacement_qbits = new_gate_tuple[1]
-                replacement_params = new_gate_tuple[2]
 
-                if type(replacement_qbits) != list:  # in some cases we may want the replacement_qbits to be a
-                    # function of the current params, in this case replacement_params is not a list, but a function
-                    replacement_qbits = [replacement_qbits(qbits)]
+def build_rule_table(rules):
+    """
+    Takes an ordered list of (gate_name, replacement_gates) rules, the same arguments one would pass to
+    successive general_replace calls, and resolves them into a dict mapping each gate_name to its
+    full decomposition. A replacement gate that is itself rewritten by a later rule is expanded ahead
+    of time, so a single rule_replace sweep gives the same gate_lst as applying the rules one by one.
 
-                elif not replacement_qbits:        # if no replacement qbit indicies have been specified,
-                    replacement_qbits = qbits      # just apply the replacement gate on the same qbits as the old gate
+    :param rules: a list of tuples, (gate_name, replacement_gates) in the order they should be applied
+    :return: rule_table: dict, {gate_name: replacement_gates} with every replacement fully resolved
+    """
 
-                if type(replacement_params) != list:  # in some cases we may want the replacement_params to be a
-                    # function of the current params, in this case replacement_params is not a list, but a function
-                    replacement_params = [replacement_params(parms)]
+    rule_table = {}
+    for gate_name, replacement_gates in reversed(rules):  # a rule only sees the rules applied after it
+        resolved = []
+        for new_gate_tuple in replacement_gates:
+            replacement_gate_name = new_gate_tuple[0]
 
-                new_gate = (replacement_gate_name, replacement_qbits, replacement_params)
-                gate_lst.insert(index + i, new_gate)
+            if replacement_gate_name in rule_table:      # this replacement gets rewritten again later on, so
+                for child_tuple in rule_table[replacement_gate_name]:     # substitute its decomposition now
+                    resolved.append(_compose_replacement(new_gate_tuple, child_tuple))
+            else:
+                resolved.append(new_gate_tuple)
 
-    return
+        rule_table[gate_name] = resolved
+
+    return rule_table
+
+
+def _compose_replacement(parent_tuple, child_tuple):
+    """
+    Combines a replacement gate tuple (parent) with a tuple from the decomposition
+    of the parent's gate (child) into a single tuple acting on the original gate.
+
+    :param parent_tuple: tuple, ('new_gate_str', [new_qbits] or func, [params] or func)
+    :param child_tuple: tuple, ('new_gate_str', [new_qbits] or func, [params] or func)
+    :return: tuple, ('new_gate_str', [new_qbits] or func, [params] or func)
+    """
+
+    parent_qbits, parent_params = parent_tuple[1], parent_tuple[2]
+    child_gate_name, child_qbits, child_params = child_tuple
+
+    if type(child_qbits) == list:
+        if not child_qbits:              # the child acts on the same qbits as the parent
+            child_qbits = parent_qbits
+    elif type(parent_qbits) == list:
+        if parent_qbits:                 # the parent qbits are fixed, so we can evaluate the child func right away
+            child_qbits = [child_qbits(parent_qbits)]
+    else:
+        child_qbits = _chain(child_qbits, parent_qbits)
+
+    if type(child_params) != list:
+        if type(parent_params) == list:  # the parent params are fixed, so we can evaluate the child func right away
+            child_params = [child_params(parent_params)]
+        else:
+            child_params = _chain(child_params, parent_params)
+
+    return child_gate_name, child_qbits, child_params
+
+
+def _chain(child_func, parent_func):
+    """ returns the func applying child_func to the (list wrapped) output of parent_func """
+    return lambda lst: child_func([parent_func(lst)])
+
+
+def rule_replace(gate_lst, rule_table):
+    """
+    Rewrites gate_lst in a single sweep. Every gate whose gate_str is in rule_table is replaced by
+    its decomposition (a list of replacement gate tuples, in the same format used by general_replace),
+    all other gates are copied over as is. The gates are appended into a new list, so the cost is
+    linear in the size of the circuit.
+
+    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    :param rule_table: dict, {gate_name: replacement_gates} eg. the output of build_rule_table
+    :return: new_gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    """
+
+    new_gate_lst = []
+    append = new_gate_lst.append
+
+    for gate in gate_lst:                                # iterate through the gate list
+        replacement_gates = rule_table.get(gate[0])
+
+        if replacement_gates is None:                    # no rule for this gate, keep it
+            append(gate)
+            continue
+
+        qbits = gate[1]
+        parms = gate[2]
+        for replacement_gate_name, replacement_qbits, replacement_params in replacement_gates:
+
+            if type(replacement_qbits) != list:  # in some cases we may want the replacement_qbits to be a
+                # function of the current qbits, in this case replacement_qbits is not a list, but a function
+                replacement_qbits = [replacement_qbits(qbits)]
+
+            elif not replacement_qbits:        # if no replacement qbit indicies have been specified,
+                replacement_qbits = qbits      # just apply the replacement gate on the same qbits as the old gate
+
+            if type(replacement_params) != list:  # in some cases we may want the replacement_params to be a
+                # function of the current params, in this case replacement_params is not a list, but a function
+                replacement_params = [replacement_params(parms)]
+
+            append((replacement_gate_name, replacement_qbits, replacement_params))
+
+    return new_gate_lst
 
 
-def random_circ_generator(num_qbits=0, num_gates=0):
+def iter_rule_replace(gates, rule_table, chunksize=1024):
+    """
+    The streaming version of rule_replace, the gates are read and rewritten chunksize at a time
+    (so an iterable of any length can be rewritten with a fixed amount of memory).
+
+    :param gates: an iterable of tuples eg. ('gate_str', [qbits], [params])
+    :param rule_table: dict, {gate_name: replacement_gates} eg. the output of build_rule_table
+    :param chunksize: int, number of gates rewritten at a time
+    :return: generator over the new gate tuples
+    """
+
+    gates = iter(gates)
+    chunk = list(islice(gates, chunksize))
+    while chunk:
+        yield from rule_replace(chunk, rule_table)
+        chunk = list(islice(gates, chunksize))
+
+
+def ir_replace(ir, rule_table):
+    """
+    The GateIR version of rule_replace. The decompositions are expanded with numpy
+    (np.repeat over the opcode array) rather than gate by gate. This requires that the
+    replacement qbits are [], a fixed list, get_first or get_second and that the replacement
+    params are a fixed list or get_first, otherwise we fall back on rule_replace.
+
+    :param ir: GateIR
+    :param rule_table: dict, {gate_name: replacement_gates} eg. the output of build_rule_table
+    :return: new GateIR
+    """
+
+    plan = {}
+    for gate_name, replacement_gates in rule_table.items():
+        specs = [_vector_spec(new_gate_tuple) for new_gate_tuple in replacement_gates]
+
+        if None in specs:   # the rule uses a func we can't vectorize
+            return GateIR.from_gate_lst(rule_replace(ir.to_gate_lst(), rule_table), ir.num_qbits)
+        plan[gate_op_dict[gate_name]] = specs
+
+    lengths = np.ones(len(gate_str_dict), dtype=np.int64)   # number of gates each opcode expands into
+    for op, specs in plan.items():
+        lengths[op] = len(specs)
+
+    reps = lengths[ir.ops]
+    src = np.repeat(np.arange(len(ir)), reps)                        # index of the gate each new gate came from
+    offset = np.arange(len(src)) - np.repeat(np.cumsum(reps) - reps, reps)  # position within the decomposition
+    src_ops = ir.ops[src]
+
+    new_ops = src_ops.copy()
+    new_qbits = ir.qbits[src]
+    new_params = ir.params[src]
+
+    for op, specs in plan.items():
+        rows = np.flatnonzero(src_ops == op)
+        for j, (new_op, qbit_spec, param_spec) in enumerate(specs):
+            sel = rows[offset[rows] == j]
+            new_ops[sel] = new_op
+
+            if type(qbit_spec) == int:              # pick one of the old qbits
+                new_qbits[sel, 0] = ir.qbits[src[sel], qbit_spec]
+                new_qbits[sel, 1] = -1
+            elif qbit_spec is not None:             # fixed qbits
+                new_qbits[sel] = qbit_spec
+
+            if param_spec is not None:              # fixed param (or nan)
+                new_params[sel] = param_spec
+
+    return GateIR(new_ops, new_qbits, new_params, ir.num_qbits)
+
+
+def _vector_spec(new_gate_tuple):
+    """
+    Translates a replacement gate tuple into (new_op, qbit_spec, param_spec) for ir_replace,
+    where qbit_spec is None (same qbits), a column index or a fixed pair of qbits and param_spec
+    is None (same param) or a float. Returns None if the tuple can't be vectorized.
+    """
+
+    replacement_gate_name, replacement_qbits, replacement_params = new_gate_tuple
+
+    if type(replacement_qbits) == list:
+        if len(replacement_qbits) > 2:
+            return None
+        qbit_spec = (replacement_qbits + [-1, -1])[:2] if replacement_qbits else None
+    elif replacement_qbits is get_first:
+        qbit_spec = 0
+    elif replacement_qbits is get_second:
+        qbit_spec = 1
+    else:
+        return None
+
+    if type(replacement_params) == list:
+        if len(replacement_params) > 1:
+            return None
+        param_spec = float(replacement_params[0]) if replacement_params else np.nan
+    elif replacement_params is get_first:
+        param_spec = None
+    else:
+        return None
+
+    return gate_op_dict[replacement_gate_name], qbit_spec, param_spec
+
+
+def circuit_depth(gate_lst, num_qbits):
+    """
+    Computes the depth of a circuit (the length of its longest chain of gates
+    which share a qbit), using one frontier per qbit.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param num_qbits: int, number of qbits in circuit
+    :return: int, depth
+    """
+
+    frontier = [0] * num_qbits  # depth of the last gate on each qbit
+    for gate in gate_lst:
+        qbit_lst = gate[1]
+        layer = max(frontier[qbit] for qbit in qbit_lst) + 1
+        for qbit in qbit_lst:
+            frontier[qbit] = layer
+
+    return max(frontier, default=0)
+
+
+def random_circ_generator(num_qbits=0, num_gates=0, seed=None):
     """
     Generate a random qiskit circuit made up of the given 'simple'
     gates. One can specify the num of qbits and num of gates in the circuit.
-    If unspecified, they will be randomly determined
+    If unspecified, they will be randomly determined (see random_circ_ir
+    for large circuits).
 
     :param num_qbits: int, optional number of qbits in circuit
     :param num_gates: int, optional number of gates
+    :param seed: optional int, seed for the random number generator
     :return: qiskit QuantumCircuit object
     """
 
+    rand = random if seed is None else random.Random(seed)  # seed=None uses (and follows random.seed of) the global rng
+
     if num_qbits == 0:
-        num_qbits = random.randint(1, 5)  # randomly pick # of qbits 1 - 5
+        num_qbits = rand.randint(1, 5)  # randomly pick # of qbits 1 - 5
 
     if num_gates == 0:
-        num_gates = random.randint(5, 25)  # randomly pick # of gates 5 - 25
+        num_gates = rand.randint(5, 25)  # randomly pick # of gates 5 - 25
 
     gate_lst = []
 
     for i in range(num_gates):                               # iterate over the number of gates
 
         if num_qbits == 1:                                       # if there  is only 1 qbit then,
-            gate_index = random.randint(0, 7)                    # pick a single qbit gate at random
+            gate_index = rand.randint(0, 7)                      # pick a single qbit gate at random
         else:
-            gate_index = random.randint(0, 9)                    # pick any gate at random
+            gate_index = rand.randint(0, 9)                      # pick any gate at random
 
         gate_str = gate_str_dict[gate_index]
-        control_index = random.randint(0, num_qbits - 1)         # pick a qbit to apply gate too
+        control_index = rand.randint(0, num_qbits - 1)           # pick a qbit to apply gate too
 
         parameter = []
         qbits = [control_index]
 
         if gate_str in ['Cx', 'Cz']:                           # if the gate is a ControlX or ControlZ
-            target_index = random.randint(0, num_qbits - 1)        # pick target qbit
+            target_index = rand.randint(0, num_qbits - 1)          # pick target qbit
 
             if target_index == control_index:                 # make sure its not the same as the control qbit
                 if control_index == num_qbits - 1:
@@ -184,10 +581,10 @@ def random_circ_generator(num_qbits=0, num_gates=0):
             qbits.append(target_index)
 
         elif gate_str in ['Rx', 'Ry']:                        # if the gate has a theta parameter
-            parameter.append(random.random() * (2 * np.pi))   # randomly select parameter
+            parameter.append(rand.random() * (2 * np.pi))     # randomly select parameter
 
         elif gate_str == 'Rz':                                # if the gate has a phi parameter
-            parameter.append(random.random() * np.pi)         # randomly select parameter
+            parameter.append(rand.random() * np.pi)           # randomly select parameter
 
         gate_lst.append((gate_str, qbits, parameter))   # add the meta_data to the gate_lst
 
@@ -195,36 +592,223 @@ def random_circ_generator(num_qbits=0, num_gates=0):
     return circ
 
 
-def circ_equal(circ1, circ2):
+def random_circ_ir(num_qbits, depth, gate_mix=None, seed=None, as_circuit=False):
+    """
+    Generate a random circuit as a GateIR, with all of the gates drawn at once using numpy.
+    The circuit is built in 'depth' layers. In each layer the qbits are randomly paired up,
+    and each pair gets either one two qbit gate or a single qbit gate on each qbit, so that
+    the fraction of each gate in the circuit follows gate_mix.
+
+    :param num_qbits: int, number of qbits in circuit
+    :param depth: int, number of layers
+    :param gate_mix: optional dict, {gate_str: weight} (defaults to equal weights for the gates I to Cz)
+    :param seed: optional int, seed for the random number generator
+    :param as_circuit: bool, if True build and return a qiskit QuantumCircuit object instead
+    :return: GateIR (or qiskit QuantumCircuit object)
+    """
+
+    if gate_mix is None:
+        gate_mix = {gate_str_dict[op]: 1.0 for op in range(10)}  # I, H, X, Y, Z, Rx, Ry, Rz, Cx, Cz
+
+    rng = np.random.default_rng(seed)
+    one_qbit = [(gate_op_dict[gate_str], weight) for gate_str, weight in gate_mix.items()
+                if weight > 0 and gate_str not in ['Cx', 'Cz', 'S']]
+    two_qbit = [(gate_op_dict[gate_str], weight) for gate_str, weight in gate_mix.items()
+                if weight > 0 and gate_str in ['Cx', 'Cz', 'S'] and num_qbits > 1]
+    weight_one = sum(weight for op, weight in one_qbit)
+    weight_two = sum(weight for op, weight in two_qbit)
+
+    if weight_one + weight_two <= 0:
+        raise ValueError('gate_mix must give a positive weight to at least one usable gate')
+
+    frac_two = weight_two / (weight_one + weight_two)   # a pair gives 1 two qbit gate or 2 single qbit gates, so
+    prob_two = 2 * frac_two / (1 + frac_two)             # pick two qbit gates w/ this prob to get frac_two overall
+
+    num_pairs = num_qbits // 2
+    perm = np.argsort(rng.random((depth, num_qbits)), axis=1).astype(np.int32)  # random order of qbits per layer
+    is_two = rng.random((depth, num_pairs)) < prob_two
+
+    ops = np.zeros((depth, num_qbits), dtype=np.int8)   # one slot per qbit, per layer
+    if one_qbit:
+        ops[:] = rng.choice([op for op, weight in one_qbit], size=(depth, num_qbits),
+                            p=[weight / weight_one for op, weight in one_qbit])
+    qbits = np.full((depth, num_qbits, 2), -1, dtype=np.int32)
+    qbits[:, :, 0] = perm
+    keep = np.full((depth, num_qbits), bool(one_qbit))
+
+    first, second = slice(0, 2 * num_pairs, 2), slice(1, 2 * num_pairs, 2)  # the two slots of each pair
+    if two_qbit:
+        ops_two = rng.choice([op for op, weight in two_qbit], size=(depth, num_pairs),
+                             p=[weight / weight_two for op, weight in two_qbit])
+        ops[:, first] = np.where(is_two, ops_two, ops[:, first])
+        qbits[:, first, 1] = np.where(is_two, perm[:, second], -1)
+        keep[:, first] |= is_two
+        keep[:, second] &= ~is_two                      # the second qbit is used by the two qbit gate
+
+    params = np.where(np.isin(ops, [gate_op_dict['Rx'], gate_op_dict['Ry'], gate_op_dict['Rz']]),
+                      rng.random((depth, num_qbits)) * (2 * np.pi), np.nan)
+
+    ir = GateIR(ops[keep], qbits[keep], params[keep], num_qbits)
+    if as_circuit:
+        return write_circ(ir)
+    return ir
+
+
+def circ_equal(circ1, circ2, num_random_states=4, seed=None, atol=1e-6):
+    """
+    Checks if two circuits are the same (up to a global phase), by simulating them
+    on the |0...0> state as well as a batch of random input states.
+    Use check_equivalence to get more information when they are different.
+
+    :param circ1: Qiskit QuantumCircuit object (or a GateIR)
+    :param circ2: Qiskit QuantumCircuit object (or a GateIR)
+    :param num_random_states: int, number of random input states to check (on top of |0...0>)
+    :param seed: optional int, seed for the random input states
+    :param atol: float, tolerance on the entries of the output states
+    :return: numpy bool, True if the circuits are equal (.all() works on it like on the old elementwise result)
+    """
+
+    return np.bool_(check_equivalence(circ1, circ2, num_random_states, seed, atol)['equal'])
+
+
+def check_equivalence(circ1, circ2, num_random_states=4, seed=None, atol=1e-6):
+    """
+    Simulates two circuits on the |0...0> state and a batch of random input states and
+    checks that the output states agree up to one global phase (the same for every input).
+
+    :param circ1: Qiskit QuantumCircuit object (or a GateIR)
+    :param circ2: Qiskit QuantumCircuit object (or a GateIR)
+    :param num_random_states: int, number of random input states to check (on top of |0...0>)
+    :param seed: optional int, seed for the random input states
+    :param atol: float, tolerance on the entries of the output states
+    :return: dict, {'equal': Bool, 'phase': complex global phase between the circuits,
+                    'max_error': float largest deviation of an entry,
+                    'fidelities': array |<psi1|psi2>|^2 per input state}
     """
-    Checks if two circuits generate the same statevector.
-    If they are different it prints them.
 
-    :param circ1: Qiskit QuantumCircuit object
-    :param circ2: Qiskit QuantumCircuit object
-    :return: Bool, True if the state vectors are equal
+    gate_lst1, num_qbits1 = _gates_of(circ1)
+    gate_lst2, num_qbits2 = _gates_of(circ2)
+    num_qbits = max(num_qbits1, num_qbits2)
+
+    states = random_states(num_qbits, num_random_states, seed)
+    out1 = simulate(gate_lst1, num_qbits, states.copy())
+    out2 = simulate(gate_lst2, num_qbits, states)
+
+    overlaps = np.einsum('ij,ij->j', np.conj(out1), out2)   # <psi1|psi2> for each input state
+    total = overlaps.sum()
+    phase = total / abs(total) if abs(total) > atol else 1.0
+    max_error = float(np.max(np.abs(out2 - phase * out1)))
+
+    return {'equal': max_error <= atol, 'phase': complex(phase), 'max_error': max_error,
+            'fidelities': np.abs(overlaps) ** 2}
+
+
+def _gates_of(circ):
+    """ returns the gate_lst and num_qbits of a qiskit circuit or GateIR """
+    if isinstance(circ, GateIR):
+        return circ, circ.num_qbits
+    return iter_circ(circ), circ.num_qubits
+
+
+def random_states(num_qbits, num_random_states, seed=None):
+    """
+    Returns a batch of input states: |0...0> followed by num_random_states
+    random (normalized) states, as the columns of a (2**num_qbits, batch) array.
     """
 
-    backend = Aer.get_backend('statevector_simulator')   # get simulator
-    job1 = execute(circ1, backend)
-    job2 = execute(circ2, backend)
-    result1 = job1.result()
-    result2 = job2.result()
+    rng = np.random.default_rng(seed)
+    states = rng.normal(size=(2 ** num_qbits, num_random_states + 1)) + \
+        1j * rng.normal(size=(2 ** num_qbits, num_random_states + 1))
+    states[:, 0] = 0
+    states[0, 0] = 1
+    states /= np.linalg.norm(states, axis=0)
+    return states
 
-    circ1_statevect = result1.get_statevector(circ1)
-    mag_circ1_statevect = np.sqrt(circ1_statevect * np.conj(circ1_statevect))
-    circ2_statevect = result2.get_statevector(circ2)
-    mag_circ2_statevect = np.sqrt(circ2_statevect * np.conj(circ2_statevect))
 
-    equal = np.isclose(mag_circ1_statevect, mag_circ2_statevect)  # check if entries are within tolerance of each other
+def simulate(gate_lst, num_qbits, states=None):
+    """
+    Applies the gates of a circuit to a batch of statevectors (in place). Basis states
+    are indexed like qiskit, qbit 0 is the least significant bit. Each gate is applied
+    by reshaping the state into (left, 2, right) blocks around its qbit(s) and updating
+    the blocks directly, so no full unitary is ever built.
 
-    if not equal.all():
-        print(np.round(circ1_statevect, decimals=3))
-        print(np.round(mag_circ1_statevect, decimals=3))
-        print(np.round(circ2_statevect, decimals=3))
-        print(np.round(mag_circ2_statevect, decimals=3))
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param num_qbits: int, number of qbits in circuit
+    :param states: optional complex array (2**num_qbits, batch), defaults to the |0...0> state
+    :return: states: complex array (2**num_qbits, batch), the output states
+    """
 
-    return equal
+    if states is None:
+        states = np.zeros((2 ** num_qbits, 1), dtype=complex)
+        states[0, 0] = 1
+    states = np.ascontiguousarray(states, dtype=complex)  # the reshapes below must be views
+
+    batch = states.shape[1]
+    for gate_str, qbit_lst, params in gate_lst:
+
+        if len(qbit_lst) == 1:
+            qbit = qbit_lst[0]
+            psi = states.reshape(2 ** (num_qbits - qbit - 1), 2, (2 ** qbit) * batch)
+            zero, one = psi[:, 0, :], psi[:, 1, :]
+
+            if gate_str in ['Rz', 'Z', 'I']:                    # diagonal gates, scale each half
+                if gate_str == 'Z':
+                    one *= -1
+                elif gate_str == 'Rz':
+                    angle = float(params[0])                # eg. a bound qiskit ParameterExpression
+                    zero *= np.exp(-0.5j * angle)
+                    one *= np.exp(0.5j * angle)
+
+            elif gate_str == 'X':                               # swap the two halves
+                psi[:, [0, 1], :] = psi[:, [1, 0], :]
+
+            else:
+                matrix = _single_qbit_matrix(gate_str, params)
+                new_zero = matrix[0, 0] * zero + matrix[0, 1] * one
+                one *= matrix[1, 1]
+                one += matrix[1, 0] * zero
+                zero[...] = new_zero
+
+        else:
+            qbit1, qbit2 = qbit_lst
+            high, low = max(qbit1, qbit2), min(qbit1, qbit2)
+            psi = states.reshape(2 ** (num_qbits - high - 1), 2, 2 ** (high - low - 1), 2, (2 ** low) * batch)
+
+            def block(bit1, bit2):  # the block of amplitudes where qbit1 = bit1, qbit2 = bit2
+                bits = (bit1, bit2) if qbit1 == high else (bit2, bit1)
+                return psi[:, bits[0], :, bits[1], :]
+
+            if gate_str == 'Cz':
+                block(1, 1)[...] *= -1
+            elif gate_str == 'Cx':
+                one_zero = block(1, 0).copy()
+                block(1, 0)[...] = block(1, 1)
+                block(1, 1)[...] = one_zero
+            elif gate_str == 'S':
+                zero_one = block(0, 1).copy()
+                block(0, 1)[...] = block(1, 0)
+                block(1, 0)[...] = zero_one
+            else:
+                raise ValueError("can't simulate the gate '{}'".format(gate_str))
+
+    return states
+
+
+def _single_qbit_matrix(gate_str, params):
+    """ returns the 2x2 unitary of a single qbit gate """
+
+    if gate_str == 'H':
+        return np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+    if gate_str == 'Y':
+        return np.array([[0, -1j], [1j, 0]])
+
+    angle = float(params[0])  # eg. a bound qiskit ParameterExpression
+    cos, sin = np.cos(angle / 2), np.sin(angle / 2)
+    if gate_str == 'Rx':
+        return np.array([[cos, -1j * sin], [-1j * sin, cos]])
+    if gate_str == 'Ry':
+        return np.array([[cos, -sin], [sin, cos]])
+    raise ValueError("can't simulate the gate '{}'".format(gate_str))
 
 
 def get_first(lst):
@@ -0,0 +1,143 @@
+# Pass manager, runs a configurable pipeline of compiler passes over a gate_lst
+from . import comp_utils as utils
+import time
+import tracemalloc
+
+
+class CompilerPass:
+    """
+    A single step of a pipeline: a func which takes a gate_lst and returns the
+    new gate_lst, a name to refer to it by and whether it is switched on.
+    """
+
+    __slots__ = ('name', 'func', 'enabled')
+
+    def __init__(self, name, func, enabled=True):
+        self.name = name
+        self.func = func
+        self.enabled = enabled
+
+    def __repr__(self):
+        return 'CompilerPass({!r}, enabled={})'.format(self.name, self.enabled)
+
+
+class PassManager:
+    """
+    An ordered pipeline of named passes (eg. identity removal, Cx cancellation,
+    decomposition, rotation merging, routing) which can be added, removed,
+    reordered and switched on or off. Every callback registered with add_callback
+    is called after each pass with a dict of metrics:
+
+    {'pass': name, 'time_s': float, 'peak_mem_bytes': int or None,
+     'gates_before': int, 'gates_after': int, 'depth_before': int, 'depth_after': int}
+
+    The peak memory is only measured (with tracemalloc) if track_memory is True, and
+    no metrics are computed at all if there are no callbacks.
+    """
+
+    def __init__(self, passes=(), callbacks=(), track_memory=False):
+        self.passes = [compiler_pass if isinstance(compiler_pass, CompilerPass) else CompilerPass(*compiler_pass)
+                       for compiler_pass in passes]
+        self.callbacks = list(callbacks)
+        self.track_memory = track_memory
+
+    @property
+    def names(self):
+        return [compiler_pass.name for compiler_pass in self.passes]
+
+    def append(self, name, func, enabled=True):
+        """ adds a pass at the end of the pipeline """
+        self.insert(len(self.passes), name, func, enabled)
+
+    def insert(self, index, name, func, enabled=True):
+        """ adds a pass at position index of the pipeline """
+        if name in self.names:
+            raise ValueError("there is already a pass called '{}'".format(name))
+        self.passes.insert(index, CompilerPass(name, func, enabled))
+
+    def remove(self, name):
+        """ removes a pass from the pipeline """
+        self.passes.remove(self[name])
+
+    def enable(self, name):
+        self[name].enabled = True
+
+    def disable(self, name):
+        self[name].enabled = False
+
+    def reorder(self, names):
+        """ puts the passes in the order given by names (a list containing every pass name once) """
+        if sorted(names) != sorted(self.names):
+            raise ValueError('reorder needs each of the passes {} exactly once'.format(self.names))
+        self.passes = [self[name] for name in names]
+
+    def add_callback(self, callback):
+        """ registers a func which is called with the metrics dict of every pass """
+        self.callbacks.append(callback)
+
+    def copy(self):
+        """ returns a new PassManager with the same passes (and settings), which can be changed independently """
+        return PassManager([CompilerPass(p.name, p.func, p.enabled) for p in self.passes],
+                           self.callbacks, self.track_memory)
+
+    def __getitem__(self, name):
+        for compiler_pass in self.passes:
+            if compiler_pass.name == name:
+                return compiler_pass
+        raise KeyError("no pass called '{}'".format(name))
+
+    def run(self, gate_lst, num_qbits=None):
+        """
+        Runs the enabled passes over gate_lst in order.
+
+        :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+        :param num_qbits: optional int, number of qbits in circuit (used for the depth metrics)
+        :return: new_gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+        """
+
+        for compiler_pass in self.passes:
+            if not compiler_pass.enabled:
+                continue
+
+            if not self.callbacks:                       # nothing is listening, so skip the metrics
+                gate_lst = compiler_pass.func(gate_lst)
+                continue
+
+            gate_lst = self._run_measured(compiler_pass, gate_lst, num_qbits)
+
+        return gate_lst
+
+    def _run_measured(self, compiler_pass, gate_lst, num_qbits):
+        """ runs a single pass and sends its metrics to the callbacks """
+
+        if num_qbits is None:
+            num_qbits = _num_qbits(gate_lst)
+        metrics = {'pass': compiler_pass.name, 'gates_before': len(gate_lst),
+                   'depth_before': utils.circuit_depth(gate_lst, num_qbits), 'peak_mem_bytes': None}
+
+        tracing = self.track_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.track_memory:
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        gate_lst = compiler_pass.func(gate_lst)
+        metrics['time_s'] = time.perf_counter() - start
+
+        if self.track_memory:
+            metrics['peak_mem_bytes'] = tracemalloc.get_traced_memory()[1]
+        if tracing:
+            tracemalloc.stop()
+
+        metrics['gates_after'] = len(gate_lst)
+        metrics['depth_after'] = utils.circuit_depth(gate_lst, max(num_qbits, _num_qbits(gate_lst)))
+        for callback in self.callbacks:
+            callback(metrics)
+
+        return gate_lst
+
+
+def _num_qbits(gate_lst):
+    """ the number of qbits a gate_lst acts on (the largest qbit index + 1) """
+    return max((max(gate[1]) for gate in gate_lst), default=-1) + 1
@@ -0,0 +1,268 @@
+# OpenQASM 2 input / output for gate_lst's, without going through qiskit
+from . import comp_utils as utils
+from . import qcomp
+from functools import lru_cache
+from itertools import chain
+import ast
+import math
+import mmap
+import operator
+import os
+import re
+
+qasm_gate_dict = {'id': 'I', 'h': 'H', 'x': 'X', 'y': 'Y', 'z': 'Z', 'rx': 'Rx', 'ry': 'Ry', 'rz': 'Rz',
+                  'cx': 'Cx', 'CX': 'Cx', 'cz': 'Cz', 'swap': 'S'}  # qasm gate name --> gate_str
+gate_qasm_dict = {'I': 'id', 'H': 'h', 'X': 'x', 'Y': 'y', 'Z': 'z', 'Rx': 'rx', 'Ry': 'ry', 'Rz': 'rz',
+                  'Cx': 'cx', 'Cz': 'cz', 'S': 'swap'}                 # gate_str --> qasm gate name
+ignored_statements = {'OPENQASM', 'include', 'creg', 'barrier', 'measure'}
+max_exponent = 1024  # largest power (in absolute value) a parameter expression may raise to
+
+_statement_re = re.compile(r'^([A-Za-z_]\w*)\s*(?:\((.*)\))?\s*(.*)$', re.S)
+_qbit_re = re.compile(r'^([A-Za-z_]\w*)\s*(?:\[\s*(\d+)\s*\])?$')
+
+
+class QasmReader:
+    """
+    Reads OpenQASM 2 statements and yields the gate tuples eg. ('gate_str', [qbits], [params]).
+    The qbits of every qreg are numbered one after the other (in the order they are declared),
+    num_qbits holds the total number of qbits declared so far.
+    """
+
+    def __init__(self):
+        self.qregs = {}     # qreg name --> (index of its first qbit, size)
+        self.num_qbits = 0
+
+    def read(self, lines):
+        """
+        :param lines: iterable of str, the lines (or any chunks) of the qasm program
+        :return: generator of gate tuples eg. ('gate_str', [qbits], [params])
+        """
+
+        for statement in iter_statements(lines):
+            match = _statement_re.match(statement)
+            if match is None:
+                raise ValueError("can't parse the qasm statement '{}'".format(statement))
+            name, param_str, arg_str = match.groups()
+
+            if name in ignored_statements:
+                continue
+
+            if name == 'qreg':
+                reg_name, size = _qbit_re.match(arg_str.strip()).groups()
+                self.qregs[reg_name] = (self.num_qbits, int(size))
+                self.num_qbits += int(size)
+                continue
+
+            gate_str = qasm_gate_dict.get(name)
+            if gate_str is None:
+                raise ValueError("unsupported qasm statement '{}'".format(statement))
+
+            params = [evaluate_param(param_str.strip())] if param_str else []
+            args = [self._qbits(arg) for arg in arg_str.split(',')]
+            width = max(len(arg) for arg in args)  # a whole register applies the gate to each of its qbits
+
+            for i in range(width):
+                yield gate_str, [arg[i] if len(arg) > 1 else arg[0] for arg in args], params
+
+    def _qbits(self, arg):
+        """ returns the list of qbit indicies referred to by 'q[i]' (one qbit) or 'q' (the whole qreg) """
+        match = _qbit_re.match(arg.strip())
+        if match is None or match.group(1) not in self.qregs:
+            raise ValueError("unknown qbit '{}'".format(arg.strip()))
+
+        offset, size = self.qregs[match.group(1)]
+        if match.group(2) is None:
+            return list(range(offset, offset + size))
+        return [offset + int(match.group(2))]
+
+
+def iter_statements(lines):
+    """ splits the lines of a qasm program into statements (without comments or the ';') """
+
+    buffer = ''
+    for line in lines:
+        buffer += line.split('//', 1)[0] + ' '
+        if ';' not in buffer:
+            continue
+
+        *statements, buffer = buffer.split(';')
+        for statement in statements:
+            statement = statement.strip()
+            if statement.startswith(('gate ', 'opaque ', 'if')) or '{' in statement:
+                raise ValueError("unsupported qasm statement '{}'".format(statement))
+            if statement:
+                yield statement
+
+    if buffer.strip():
+        raise ValueError("the qasm program ends without a ';' after '{}'".format(buffer.strip()))
+
+
+def _pow(base, exponent):
+    """ a ** b on floats, without letting one parameter run for ever (or build a huge number) """
+    if abs(exponent) > max_exponent:
+        raise ValueError('the exponent {!r} in a qasm parameter is too large'.format(exponent))
+    result = base ** exponent
+    if isinstance(result, complex):  # eg. (-8) ^ 0.5
+        raise ValueError('the qasm parameter {!r} ^ {!r} is not a real number'.format(base, exponent))
+    return result
+
+
+_binary_ops = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+               ast.Pow: _pow}
+_unary_ops = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+_functions = {'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'exp': math.exp, 'ln': math.log, 'sqrt': math.sqrt}
+
+
+@lru_cache(maxsize=4096)
+def evaluate_param(expr):
+    """ evaluates a qasm parameter expression such as '-pi/2' or '3*pi/4 + 0.1' (cached) """
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return float(node.value)  # float arithmetic overflows quickly instead of growing without bound
+        if isinstance(node, ast.Name) and node.id == 'pi':
+            return math.pi
+        if isinstance(node, ast.BinOp) and type(node.op) in _binary_ops:
+            return _binary_ops[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_ops:
+            return _unary_ops[type(node.op)](evaluate(node.operand))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _functions
+                and len(node.args) == 1):
+            return _functions[node.func.id](evaluate(node.args[0]))
+        raise ValueError("can't evaluate the qasm parameter '{}'".format(expr))
+
+    value = evaluate(ast.parse(expr.replace('^', '**'), mode='eval'))
+    if not math.isfinite(value):
+        raise ValueError("the qasm parameter '{}' is not finite".format(expr))
+    return value
+
+
+def read_qasm(qasm_str):
+    """
+    Reads an OpenQASM 2 program (as a str) into a gate_lst, the qasm version of read_circ.
+
+    :param qasm_str: str, the qasm program
+    :return: gate_lst, num_qbits: a list of tuples and an int
+    """
+
+    reader = QasmReader()
+    gate_lst = list(reader.read(qasm_str.splitlines()))
+    return gate_lst, reader.num_qbits
+
+
+def read_qasm_ir(qasm_str):
+    """
+    Reads an OpenQASM 2 program (as a str) into a GateIR.
+
+    :param qasm_str: str, the qasm program
+    :return: GateIR
+    """
+
+    return utils.GateIR.from_gate_lst(*read_qasm(qasm_str))
+
+
+def iter_qasm_lines(gate_lst, num_qbits):
+    """ yields the lines (with a trailing newline) of the qasm program for a gate_lst """
+
+    yield 'OPENQASM 2.0;\n'
+    yield 'include "qelib1.inc";\n'
+    yield 'qreg q[{}];\n'.format(num_qbits)
+
+    for gate_str, qbit_lst, params in gate_lst:
+        qbits = ','.join('q[{}]'.format(qbit) for qbit in qbit_lst)
+        if params:
+            yield '{}({!r}) {};\n'.format(gate_qasm_dict[gate_str], float(params[0]), qbits)
+        else:
+            yield '{} {};\n'.format(gate_qasm_dict[gate_str], qbits)
+
+
+def write_qasm(gate_lst, num_qbits=None):
+    """
+    Writes a gate_lst (or GateIR) as an OpenQASM 2 program, the qasm version of write_circ.
+
+    :param gate_lst: list of tuples (or a GateIR), containing the meta_data of the circuit
+    :param num_qbits: int, number of qbits in circuit (optional for a GateIR)
+    :return: str, the qasm program
+    """
+
+    if num_qbits is None:
+        num_qbits = gate_lst.num_qbits
+    return ''.join(iter_qasm_lines(gate_lst, num_qbits))
+
+
+def compile_qasm(qasm_str, mode='compiler', topology=None):
+    """
+    Compiles (and optionally routes) an OpenQASM 2 program without using qiskit at all.
+
+    :param qasm_str: str, the qasm program
+    :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+    :param topology: optional dict, {qbit: [connected qbits]}, if given the circuit is also routed
+    :return: str, the compiled qasm program
+    """
+
+    if mode not in qasm_compile_modes:
+        raise ValueError("mode must be one of {}, got '{}'".format(list(qasm_compile_modes), mode))
+
+    gate_lst, num_qbits = read_qasm(qasm_str)
+    gate_lst = qasm_compile_modes[mode](gate_lst)
+
+    if topology is not None:
+        gate_lst = qcomp.route_gates(gate_lst, topology)
+        num_qbits = max(num_qbits, qcomp.get_routing_table(topology).dist.shape[0])
+
+    return write_qasm(gate_lst, num_qbits)
+
+
+def compile_qasm_file(source, destination, mode='compiler', topology=None, window=4096):
+    """
+    Compiles (and optionally routes) an OpenQASM 2 file into another one as a stream. The
+    input is read line by line (memory mapped if it is a path), compiled gate by gate with
+    qcomp.stream_compile and written out as it goes, so the memory used stays the same no
+    matter how long the circuit is. Every qreg has to be declared before the first gate.
+
+    :param source: str (path) or a file object open for reading, the qasm program
+    :param destination: str (path) or a file object open for writing (text), the compiled qasm program
+    :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+    :param topology: optional dict, {qbit: [connected qbits]}, if given the circuit is also routed
+    :param window: int, number of recent gates kept around for Cx / Cz cancellation
+    :return: int, the number of gates written
+    """
+
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:  # an empty file can't be memory mapped
+                return compile_qasm_file([], destination, mode, topology, window)
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                lines = (line.decode() for line in iter(buffer.readline, b''))
+                return compile_qasm_file(lines, destination, mode, topology, window)
+
+    if isinstance(destination, (str, os.PathLike)):
+        with open(destination, 'w') as file:
+            return compile_qasm_file(source, file, mode, topology, window)
+
+    reader = QasmReader()
+    gates = qcomp.stream_compile(reader.read(source), mode, topology, window)
+
+    first_gate = next(gates, None)  # the qregs have all been read by the time the first gate comes out
+    num_qbits = reader.num_qbits
+    if topology is not None:
+        num_qbits = max(num_qbits, qcomp.get_routing_table(topology).dist.shape[0])
+
+    if first_gate is not None:
+        gates = chain([first_gate], gates)
+    else:
+        gates = []
+
+    num_lines = 0
+    for line in iter_qasm_lines(gates, num_qbits):
+        destination.write(line)
+        num_lines += 1
+
+    if reader.num_qbits > num_qbits:
+        raise ValueError('a qreg was declared after the first gate, so the qreg written out is too small')
+    return num_lines - 3  # the header is 3 lines long
+
+
+qasm_compile_modes = {'compiler': qcomp.compile_gates, 'simple': qcomp.simple_compile_gates}
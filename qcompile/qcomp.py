@@ -1,6 +1,28 @@
 # Main file for Quantum Compiler
 from . import comp_utils as utils
+from . import passes
+from . import schedule as scheduling
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 import numpy as np
+import os
+
+
+# Decomposition rules, listed in the order the replacements are applied:
+cx_rule = ('Cx', [('H', utils.get_second, []), ('Cz', [], []), ('H', utils.get_second, [])])         # replace CNOT
+h_rule = ('H', [('Rz', [], [np.pi / 2]), ('Rx', [], [np.pi / 2]), ('Rz', [], [np.pi / 2])])          # replace Hadamard
+x_rule = ('X', [('Rx', [], [np.pi])])                                                                 # replace X
+z_rule = ('Z', [('Rz', [], [np.pi])])                                                                 # replace Z
+y_rule = ('Y', [('Rz', [], [-np.pi / 2]), ('Rx', [], [np.pi]), ('Rz', [], [np.pi / 2])])             # replace y
+ry_rule = ('Ry', [('Rz', [], [-np.pi / 2]), ('Rx', [], utils.get_first), ('Rz', [], [np.pi / 2])])   # replace Ry(theta)
+
+simple_rule_table = utils.build_rule_table([cx_rule, ('I', [('Rz', [], [0])]),  # replace Identity
+                                            h_rule, x_rule, z_rule, y_rule, ry_rule])
+compiler_rule_table = utils.build_rule_table([cx_rule, h_rule, x_rule, z_rule, y_rule, ry_rule])
+
+zero_angle_atol = 1e-8  # merged rotations closer than this to 0 (mod 2pi) are dropped
 
 
 def simple_compiler(circ):
@@ -8,183 +30,740 @@ def simple_compiler(circ):
     A simple quantum compiler that produces a new quantum circuit from
     the restricted subset of available gates.
 
-    :param circ: qiskit.QuantumCircuit object
-    :return: compiled_circ: new qiskit.QuantumCircuit object
+    :param circ: qiskit.QuantumCircuit object (or a GateIR)
+    :return: compiled_circ: new qiskit.QuantumCircuit object (or a GateIR)
     """
 
-    gate_lst, num_qbits = utils.read_circ(circ)
+    if isinstance(circ, utils.GateIR):
+        return utils.ir_replace(circ, simple_rule_table)  # vectorized over the opcode array
 
-    # replace CNOT:
-    replacement_gates = [('H', utils.get_second, []), ('Cz', [], []), ('H', utils.get_second, [])]
-    utils.general_replace(gate_lst, 'Cx', replacement_gates)
+    gate_lst, num_qbits = utils.read_circ(circ)
+    gate_lst = simple_compile_gates(gate_lst)
 
-    # replace Identity:
-    replacement_gates = [('Rz', [], [0])]
-    utils.general_replace(gate_lst, 'I', replacement_gates)
+    compiled_circ = utils.write_circ(gate_lst, num_qbits)
 
-    # replace Hadamard:
-    replacement_gates = [('Rz', [], [np.pi / 2]), ('Rx', [], [np.pi / 2]), ('Rz', [], [np.pi / 2])]
-    utils.general_replace(gate_lst, 'H', replacement_gates)
+    return compiled_circ
 
-    # replace X:
-    replacement_gates = [('Rx', [], [np.pi])]
-    utils.general_replace(gate_lst, 'X', replacement_gates)
 
-    # replace Z:
-    replacement_gates = [('Rz', [], [np.pi])]
-    utils.general_replace(gate_lst, 'Z', replacement_gates)
+def compiler(circ, pipeline=None):
+    """
+    A quantum compiler that produces a new quantum circuit from the
+    restricted subset of available gates.
 
-    # replace y:
-    replacement_gates = [('Rz', [], [-np.pi / 2]), ('Rx', [], [np.pi]), ('Rz', [], [np.pi / 2])]
-    utils.general_replace(gate_lst, 'Y', replacement_gates)
+    :param circ: qiskit.QuantumCircuit object (or a GateIR)
+    :param pipeline: optional PassManager to use instead of the default compiler_pipeline()
+    :return: compiled_circ: new qiskit.QuantumCircuit object (or a GateIR)
+    """
 
-    # replace Ry(theta):
-    replacement_gates = [('Rz', [], [-np.pi / 2]), ('Rx', [], utils.get_first), ('Rz', [], [np.pi / 2])]
-    utils.general_replace(gate_lst, 'Ry', replacement_gates)
+    gate_lst, num_qbits = _read(circ)
+    gate_lst = compile_gates(gate_lst, pipeline, num_qbits)
 
-    compiled_circ = utils.write_circ(gate_lst, num_qbits)
+    compiled_circ = _write(gate_lst, num_qbits, circ)
 
     return compiled_circ
 
 
-def compiler(circ):
+def simple_compile_gates(gate_lst):
     """
-    A quantum compiler that produces a new quantum circuit from the
-    restricted subset of available gates.
+    The simple compiler, acting directly on a gate_lst.
 
-    :param circ:
-    :return:
+    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    :return: new_gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
     """
 
-    gate_lst, num_qbits = utils.read_circ(circ)
+    return utils.rule_replace(gate_lst, simple_rule_table)  # replace every gate in a single sweep
 
-    # Preprocessing (Step1):
 
-    utils.general_replace(gate_lst, 'I', [])  # remove Identity
+def compile_gates(gate_lst, pipeline=None, num_qbits=None):
+    """
+    The compiler, acting directly on a gate_lst.
 
-    length = len(gate_lst)
-    for index in range(length - 1):  # iterate over the lst and remove redundant Cx, Cz gates
+    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    :param pipeline: optional PassManager to use instead of the default compiler_pipeline()
+    :param num_qbits: optional int, number of qbits in circuit (used for the pipeline metrics)
+    :return: new_gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    """
 
-        if index >= (len(gate_lst) - 1):  # by removing the repetitive Cz and Cx gates
-            break  # we reduce the size of the list, so we need to check this edge case
+    if pipeline is None:
+        pipeline = compiler_pipeline()
+    return pipeline.run(gate_lst, num_qbits)
 
-        curr_gate_str = gate_lst[index][0]
-        curr_qbit_lst = gate_lst[index][1]
 
-        if curr_gate_str in ['Cx', 'Cz']:  # Check if this gate is a Cz or Cx gate
-            nxt_gate_str = gate_lst[index + 1][0]
-            nxt_qbit_lst = gate_lst[index + 1][1]
+def compiler_pipeline(topology=None, callbacks=(), track_memory=False, schedule=None):
+    """
+    Builds the PassManager used by the compiler. The passes can then be reordered,
+    switched on or off (eg. pipeline.disable('merge_rotations')) and instrumented
+    with pipeline.add_callback(func), see passes.PassManager.
+
+    :param topology: optional dict, {qbit: [connected qbits]}, if given a 'route' pass is added at the end
+    :param schedule: optional str, 'asap' or 'alap', if given a 'schedule' pass is added at the very end,
+                     which orders the gates layer by layer (see schedule.py)
+    :param callbacks: funcs called with the metrics dict of every pass
+    :param track_memory: bool, if True the peak memory of every pass is measured as well
+    :return: PassManager
+    """
 
-            if ((nxt_gate_str == curr_gate_str) and  # check that we are applying a Cz or Cx gate twice
-                    (nxt_qbit_lst == curr_qbit_lst)):  # consecutively on the same control and target qbits
+    pipeline = passes.PassManager(callbacks=callbacks, track_memory=track_memory)
 
-                del gate_lst[index + 1]  # remove both gates
-                del gate_lst[index]
+    # Preprocessing (Step1):
+    pipeline.append('remove_identity', partial(utils.rule_replace, rule_table={'I': []}))  # remove Identity
+    pipeline.append('cancel_pairs', cancel_pairs)                                          # remove redundant Cx, Cz
 
     # Compile (similar to the simple compiler):
+    pipeline.append('decompose', partial(utils.rule_replace, rule_table=compiler_rule_table))
 
-    # replace CNOT:
-    replacement_gates = [('H', utils.get_second, []), ('Cz', [], []), ('H', utils.get_second, [])]
-    utils.general_replace(gate_lst, 'Cx', replacement_gates)
+    # simplification (Step2):
+    pipeline.append('fuse_rotations', fuse_rotations)
+    pipeline.append('merge_rotations', lambda gate_lst: list(merge_rotations(gate_lst)))
 
-    # replace Hadamard:
-    replacement_gates = [('Rz', [], [np.pi / 2]), ('Rx', [], [np.pi / 2]), ('Rz', [], [np.pi / 2])]
-    utils.general_replace(gate_lst, 'H', replacement_gates)
+    if topology is not None:
+        pipeline.append('route', lambda gate_lst: list(route_gates(gate_lst, topology)))
 
-    # replace X:
-    replacement_gates = [('Rx', [], [np.pi])]
-    utils.general_replace(gate_lst, 'X', replacement_gates)
+    if schedule is not None:
+        pipeline.append('schedule', partial(scheduling.schedule, mode=schedule))
 
-    # replace Z:
-    replacement_gates = [('Rz', [], [np.pi])]
-    utils.general_replace(gate_lst, 'Z', replacement_gates)
+    return pipeline
 
-    # replace y:
-    replacement_gates = [('Rz', [], [-np.pi / 2]), ('Rx', [], [np.pi]), ('Rz', [], [np.pi / 2])]
-    utils.general_replace(gate_lst, 'Y', replacement_gates)
 
-    # replace Ry(theta):
-    replacement_gates = [('Rz', [], [-np.pi / 2]), ('Rx', [], utils.get_first), ('Rz', [], [np.pi / 2])]
-    utils.general_replace(gate_lst, 'Ry', replacement_gates)
+def stream_compile(gates, mode='compiler', topology=None, window=4096):
+    """
+    The compiler (or simple compiler) as a stream: the gates are read, compiled and yielded one
+    at a time, so a circuit of any length is compiled with a fixed amount of memory. Each step of
+    the compiler pipeline is a generator: remove_identity, cancel_pairs (which only looks back at
+    the last window gates, see iter_cancel_pairs), decompose (see utils.iter_rule_replace),
+    fuse_rotations (see iter_fuse_rotations) and merge_rotations (which holds at most one pending
+    rotation per qbit), then optionally route.
+
+    :param gates: an iterable of tuples eg. ('gate_str', [qbits], [params])
+    :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+    :param topology: optional dict, {qbit: [connected qbits]}, if given the gates are also routed
+    :param window: int, number of recent gates kept around for Cx / Cz cancellation
+    :return: generator over the compiled gate tuples
+    """
 
-    # simplification (Step2):
+    if mode == 'simple':
+        gates = utils.iter_rule_replace(gates, simple_rule_table)
+    elif mode == 'compiler':
+        gates = (gate for gate in gates if gate[0] != 'I')              # remove Identity
+        gates = iter_cancel_pairs(gates, window)                        # remove redundant Cx, Cz
+        gates = utils.iter_rule_replace(gates, compiler_rule_table)     # decompose
+        gates = iter_fuse_rotations(gates)                              # simplification (Step2)
+        gates = merge_rotations(gates)
+    else:
+        raise ValueError("mode must be one of ['compiler', 'simple'], got '{}'".format(mode))
+
+    if topology is not None:
+        gates = route_gates(gates, topology)
+
+    return gates
+
+
+def compile_many(circuits, workers=None, router_topology=None, mode='compiler', chunksize=16):
+    """
+    Compiles (and optionally routes) many circuits at once, spreading the work over a pool of
+    worker processes. The circuits are sent to the workers as GateIR's (a few numpy arrays)
+    rather than as qiskit objects. A GateIR can only hold numeric angles, so circuits with
+    unbound qiskit Parameters (eg. a VQE ansatz) are sent as gate_lst's instead, which is slower
+    to pickle, and come back with their Parameters in place.
+
+    :param circuits: iterable of qiskit.QuantumCircuit objects (or GateIR's)
+    :param workers: int, number of worker processes (None uses every cpu, 1 compiles in this process)
+    :param router_topology: optional dict, {qbit: [connected qbits]}, if given each circuit is also routed
+    :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+    :param chunksize: int, number of circuits sent to a worker at a time
+    :return: list of the compiled circuits, in the same order (and form) as the input
+    """
+
+    return list(icompile_many(circuits, workers, router_topology, mode, chunksize))
+
+
+def icompile_many(circuits, workers=None, router_topology=None, mode='compiler', chunksize=16, max_chunks=None):
+    """
+    The streaming version of compile_many. The circuits are read lazily, at most max_chunks
+    chunks are being compiled at any time and the results are yielded in input order, so
+    this works for inputs which don't fit in memory.
+
+    :param circuits: iterable of qiskit.QuantumCircuit objects (or GateIR's)
+    :param workers: int, number of worker processes (None uses every cpu, 1 compiles in this process)
+    :param router_topology: optional dict, {qbit: [connected qbits]}, if given each circuit is also routed
+    :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+    :param chunksize: int, number of circuits sent to a worker at a time
+    :param max_chunks: int, max number of chunks in flight (defaults to 2 per worker)
+    :return: generator over the compiled circuits, in the same order (and form) as the input
+    """
+
+    if mode not in _compile_modes:
+        raise ValueError("mode must be one of {}, got '{}'".format(list(_compile_modes), mode))
+
+    chunks = _ir_chunks(circuits, chunksize)
+
+    if workers == 1:                                         # no need to pay for a pool
+        for is_ir, irs in chunks:
+            yield from _from_irs(is_ir, _compile_chunk(irs, mode, router_topology))
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        if max_chunks is None:
+            max_chunks = 2 * (workers or os.cpu_count() or 1)
+
+        in_flight = deque()
+        for is_ir, irs in chunks:
+            in_flight.append((is_ir, pool.submit(_compile_chunk, irs, mode, router_topology)))
 
-    index = 0
-    while index < len(gate_lst) - 1:
-        #         print('index: {}'.format(index))
-        curr_gate_str = gate_lst[index][0]
-        curr_qbit_lst = gate_lst[index][1]
-        curr_qbit_params = gate_lst[index][2]
+            if len(in_flight) >= max_chunks:                 # wait on the oldest chunk before reading more
+                is_ir, future = in_flight.popleft()
+                yield from _from_irs(is_ir, future.result())
 
-        if curr_gate_str in ['Rx', 'Rz']:  # Check if this gate is a Rz or Rx gate
-            i = 1  # another dummy index to look at gates ahead
-            while index + i < len(gate_lst):
-                #                 print('dummy: {}'.format(i))
-                nxt_gate_str = gate_lst[index + i][0]
-                nxt_qbit_lst = gate_lst[index + i][1]
-                nxt_qbit_params = gate_lst[index + i][2]
+        while in_flight:
+            is_ir, future = in_flight.popleft()
+            yield from _from_irs(is_ir, future.result())
 
-                if ((nxt_gate_str == curr_gate_str) and  # check that we are applying a Rz or Rx gate twice
-                        (nxt_qbit_lst == curr_qbit_lst)):  # consecutively on the same control and target qbits
 
-                    del gate_lst[index + i]  # remove both gates
-                    del gate_lst[index]
+_compile_modes = {'compiler': compiler, 'simple': simple_compiler}
+_gate_lst_modes = {'compiler': compile_gates, 'simple': simple_compile_gates}
 
-                    new_gate = (curr_gate_str, curr_qbit_lst, [curr_qbit_params[0] + nxt_qbit_params[0]])
-                    gate_lst.insert(index, new_gate)  # add the combined gate and
-                    break  # break current while loop
 
-                elif ((nxt_gate_str != curr_gate_str) and  # if the next gate applied to the same qbit is different
-                      (nxt_qbit_lst == curr_qbit_lst or  # i.e instead of another Rx gate we apply a Rz or a Cz to
-                       curr_qbit_lst[0] in nxt_qbit_lst)):  # the same qbit then
+def _ir_chunks(circuits, chunksize):
+    """ yields (is_ir, [GateIR or (gate_lst, num_qbits), ...]) chunks of the circuits, where is_ir
+    records which of the inputs were given as GateIR's """
+    circuits = iter(circuits)
+    while True:
+        chunk = list(islice(circuits, chunksize))
+        if not chunk:
+            return
+        is_ir = [isinstance(circ, utils.GateIR) for circ in chunk]
+        yield is_ir, [circ if ir else _for_worker(circ) for circ, ir in zip(chunk, is_ir)]
 
-                    index += 1  # move forward nothing left here to simplify
-                    break
 
-                else:  # the next gate is being applied to a different set of qbits
-                    i += 1  # so we can safely check the next gate in the list
+def _for_worker(circ):
+    """ a qiskit circuit is sent to the workers as a GateIR, unless it has unbound Parameters
+    (a GateIR only holds numeric angles), then it is sent as (gate_lst, num_qbits) """
+    if circ.parameters:
+        return utils.read_circ(circ)
+    return utils.read_circ_ir(circ)
 
-            index += 1
 
+def _compile_chunk(irs, mode, router_topology):
+    """ compiles (and routes) a chunk of GateIR's (or (gate_lst, num_qbits) pairs), this runs in the worker processes """
+    compiled = []
+    for ir in irs:
+        if isinstance(ir, utils.GateIR):
+            ir = _compile_modes[mode](ir)
+            if router_topology is not None:
+                ir = circ_router(ir, router_topology)
         else:
-            index += 1
+            gate_lst, num_qbits = ir
+            gate_lst = _gate_lst_modes[mode](gate_lst)
+            if router_topology is not None:
+                gate_lst = list(route_gates(gate_lst, router_topology))
+            ir = (gate_lst, num_qbits)
+        compiled.append(ir)
+    return compiled
+
+
+def _from_irs(is_ir, irs):
+    """ yields the compiled circuits in the same form they were given in """
+    for ir, keep_ir in zip(irs, is_ir):
+        if keep_ir:
+            yield ir
+        elif isinstance(ir, utils.GateIR):
+            yield utils.write_circ(ir)
+        else:
+            yield utils.write_circ(*ir)
 
-    compiled_circ = utils.write_circ(gate_lst, num_qbits)
 
-    return compiled_circ
+def cancel_pairs(gate_lst):
+    """
+    Removes pairs of Cx or Cz gates which cancel each other out. Two copies of the same
+    gate cancel if none of the gates in between act on either of their qbits (the gates
+    in between may act on other qbits). Cz is symmetric, so Cz(a, b) also cancels Cz(b, a).
+    For each qbit we keep a stack with the position of every gate we have kept so far on that
+    qbit (its frontier), so each gate is checked against the top of the stacks in O(1).
+
+    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    :return: new_gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    """
 
+    new_gate_lst = []
+    frontier = {}  # qbit --> stack of indicies (into new_gate_lst) of the gates acting on that qbit
 
-def get_path(topology, start, end):
-    """ Takes a dict (topology) representing the geometry of the
-    connections, an int (start) representing the starting index
-    and an int (end) representing the ending index and returns
-    a list corresponding to the shortest path from end --> start
-    (assuming a ring topology) """
+    for gate in gate_lst:
+        gate_str, qbit_lst = gate[0], gate[1]
+
+        if gate_str in ['Cx', 'Cz']:
+            cntrl_stack = frontier.get(qbit_lst[0])
+            trgt_stack = frontier.get(qbit_lst[1])
+
+            if cntrl_stack and trgt_stack and cntrl_stack[-1] == trgt_stack[-1]:  # the last gate on both qbits
+                prev_gate = new_gate_lst[cntrl_stack[-1]]                        # is the same gate
+
+                if prev_gate[0] == gate_str and (prev_gate[1] == qbit_lst or
+                                                 (gate_str == 'Cz' and prev_gate[1] == qbit_lst[::-1])):
+                    new_gate_lst[cntrl_stack[-1]] = None  # remove both gates, and expose the gates before them
+                    cntrl_stack.pop()
+                    trgt_stack.pop()
+                    continue
+
+        index = len(new_gate_lst)
+        new_gate_lst.append(gate)
+        for qbit in qbit_lst:
+            frontier.setdefault(qbit, []).append(index)
+
+    return [gate for gate in new_gate_lst if gate is not None]
+
+
+def iter_cancel_pairs(gate_lst, window=4096):
+    """
+    The streaming version of cancel_pairs. Only the last window gates are held on to (a gate
+    is written out once window more gates have been read after it), so a pair of gates more
+    than window gates apart is not cancelled, otherwise the result is the same as cancel_pairs.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params])
+    :param window: int, the number of gates held on to
+    :return: generator over the remaining gate tuples
+    """
+
+    buffer = deque()  # the last gates read (None for a cancelled gate), buffer[0] is gate number start
+    start = 0
+    frontier = {}     # qbit --> deque of the gate numbers (in the buffer) of the gates acting on that qbit
+
+    for gate in gate_lst:
+        gate_str, qbit_lst = gate[0], gate[1]
+
+        if gate_str in ['Cx', 'Cz']:
+            cntrl_stack = frontier.get(qbit_lst[0])
+            trgt_stack = frontier.get(qbit_lst[1])
+
+            if cntrl_stack and trgt_stack and cntrl_stack[-1] == trgt_stack[-1]:  # the last gate on both qbits
+                prev_gate = buffer[cntrl_stack[-1] - start]                      # is the same gate
+
+                if prev_gate[0] == gate_str and (prev_gate[1] == qbit_lst or
+                                                 (gate_str == 'Cz' and prev_gate[1] == qbit_lst[::-1])):
+                    buffer[cntrl_stack[-1] - start] = None  # remove both gates, and expose the gates before them
+                    cntrl_stack.pop()
+                    trgt_stack.pop()
+                    continue
+
+        index = start + len(buffer)
+        buffer.append(gate)
+        for qbit in qbit_lst:
+            frontier.setdefault(qbit, deque()).append(index)
+
+        if len(buffer) > window:  # write out the oldest gate, it is at the bottom of its qbits' stacks
+            old_gate = buffer.popleft()
+            start += 1
+            if old_gate is not None:
+                for qbit in old_gate[1]:
+                    frontier[qbit].popleft()
+                yield old_gate
+
+    for gate in buffer:
+        if gate is not None:
+            yield gate
+
+
+def merge_rotations(gate_lst):
+    """
+    Merges consecutive rotations about the same axis on each qbit in a single sweep.
+    For every qbit we hold on to a 'pending' Rx or Rz gate and add the angles of any
+    following rotations about the same axis into it. The pending gate is only written
+    out once a different gate acts on that qbit, and it is dropped entirely if its
+    angle is 0 (mod 2pi). Since Cz is diagonal, a pending Rz on either of its qbits
+    commutes through it and stays pending.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params])
+    :return: generator over the simplified gate tuples
+    """
+
+    pending = {}  # qbit --> (gate_str, [qbit], angle) of the rotation waiting to be written out
+
+    for gate in gate_lst:
+        gate_str, qbit_lst, params = gate
+
+        if gate_str in ['Rx', 'Rz']:
+            qbit = qbit_lst[0]
+            rotation = pending.get(qbit)
+
+            if rotation is not None and rotation[0] == gate_str:  # same axis, fold the angle in
+                pending[qbit] = (gate_str, rotation[1], rotation[2] + params[0])
+                continue
+
+            if rotation is not None:                              # different axis, write the old one out
+                yield from _flush_rotation(rotation)
+            pending[qbit] = (gate_str, qbit_lst, params[0])
+            continue
+
+        for qbit in qbit_lst:  # any other gate blocks the pending rotations on its qbits
+            rotation = pending.get(qbit)
+
+            if rotation is None or (gate_str == 'Cz' and rotation[0] == 'Rz'):  # Rz commutes with Cz
+                continue
+
+            del pending[qbit]
+            yield from _flush_rotation(rotation)
+
+        yield gate
+
+    for qbit in sorted(pending):  # write out whatever is left at the end of the circuit
+        yield from _flush_rotation(pending[qbit])
 
-    path_cw = []  # initialize the clockwise traversed path
-    path_ccw = []  # initialize the counter clockwise traversed path
 
-    path_cw.append(end)
-    path_ccw.append(end)  # add the first point
+def _flush_rotation(rotation):
+    """ yields the merged rotation gate unless it is the identity (up to a phase) """
+    gate_str, qbit_lst, angle = rotation
+    if not _is_zero_angle(angle):
+        yield gate_str, qbit_lst, [angle]
 
-    current = end
-    while start not in topology[current]:  # traverse clockwise while adding each intermediate qbit index
-        current = topology[current][1]
-        path_cw.append(current)
 
-    path_cw.append(start)
+def _is_zero_angle(angle):
+    """ checks if a rotation angle is 0 (mod 2pi), an angle which depends
+    on the circuit parameters (Angle or qiskit Parameter) is never treated as 0 """
+    angle = _numeric_angle(angle)
+    if angle is None:
+        return False
+
+    remainder = angle % (2 * np.pi)  # plain floats, np.isclose is far too slow to call per gate
+    return min(remainder, 2 * np.pi - remainder) <= zero_angle_atol
+
+
+def _numeric_angle(angle):
+    """ returns a rotation angle as a float (eg. a bound qiskit ParameterExpression), or None
+    if it depends on the circuit parameters (an Angle with terms or an unbound qiskit Parameter) """
+    if isinstance(angle, utils.Angle):
+        return None if angle.terms else float(angle.const)
+    try:
+        return float(angle)
+    except TypeError:  # an unbound parameter
+        return None
+
+
+fixed_matrices = {'I': np.eye(2), 'H': np.array([[1, 1], [1, -1]]) / np.sqrt(2), 'X': np.array([[0, 1], [1, 0]]),
+                  'Y': np.array([[0, -1j], [1j, 0]]), 'Z': np.diag([1, -1])}  # the 2x2 unitaries of the fixed gates
+fusable_gates = {'I', 'H', 'X', 'Y', 'Z', 'Rx', 'Ry', 'Rz'}
+
+
+def fuse_rotations(gate_lst):
+    """
+    Replaces each run of single qbit gates on a qbit (everything between two of the
+    multi qbit gates acting on it) by at most three rotations Rz(c), Rx(b), Rz(a).
+    The 2x2 unitaries of all the runs are multiplied together in a batch, then the
+    ZXZ Euler angles of each product U = Rz(a) Rx(b) Rz(c) (up to a phase) are
+    extracted at once, and the rotations with an angle of 0 (mod 2pi) are dropped.
+    Gates with a symbolic angle (Angle or unbound qiskit Parameter) are left as they are,
+    and end the run on their qbit like a multi qbit gate. Bound angles (eg. a qiskit
+    ParameterExpression after assign_parameters) are fused like plain floats.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params])
+    :return: new_gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+    """
+
+    placed = []     # the gates which are kept, with a None where the fused gates of each run go
+    open_runs = {}  # qbit --> index of the run currently being collected on that qbit
+    runs = []       # the gates of each run, in order
+
+    for gate in gate_lst:
+        fusable = _fusable(gate)
+        if fusable is not None:
+            qbit = fusable[1][0]
+            run = open_runs.get(qbit)
+            if run is None:                      # start a new run, its gates go where its first gate was
+                run = open_runs[qbit] = len(runs)
+                runs.append([])
+                placed.append(None)
+            runs[run].append(fusable)
+            continue
+
+        for qbit in gate[1]:                     # any other gate ends the runs on its qbits
+            open_runs.pop(qbit, None)
+        placed.append(gate)
+
+    fused = iter(_fuse_runs(runs))
+    new_gate_lst = []
+    for gate in placed:
+        if gate is None:
+            new_gate_lst.extend(next(fused))
+        else:
+            new_gate_lst.append(gate)
+
+    return new_gate_lst
 
-    current = end
-    while start not in topology[current]:  # traverse counter clockwise while adding each intermediate qbit index
-        current = topology[current][0]
-        path_ccw.append(current)
 
-    path_ccw.append(start)
+def _fusable(gate):
+    """ returns the gate (with its angle as a float) if it can go in a run of fuse_rotations, else None """
+    gate_str, qbit_lst, params = gate
+    if gate_str not in fusable_gates:
+        return None
+    if not params or isinstance(params[0], float):  # np.float64 is a float
+        return gate
 
-    if len(path_cw) <= len(path_ccw):  # return the shorter among the two paths
-        return path_cw
+    angle = _numeric_angle(params[0])
+    if angle is None:
+        return None
+    return gate_str, qbit_lst, [angle]
+
+
+def iter_fuse_rotations(gate_lst, max_run=256, chunksize=1024):
+    """
+    The streaming version of fuse_rotations. The run on each qbit is held on to until a gate
+    which ends it comes along, and its fused rotations are written out just before that gate.
+    The ended runs are fused chunksize gates (and runs) at a time, so they still go through
+    _fuse_runs in batches. A run which grows past max_run gates is fused early, and its rotations
+    start the rest of the run.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params])
+    :param max_run: int, max number of gates held on to per qbit
+    :param chunksize: int, number of gates and ended runs collected before they are written out
+    :return: generator over the new gate tuples
+    """
+
+    runs = {}     # qbit --> the gates of the run currently being collected on that qbit
+    placed = []   # the gates ready to be written out, with a None where the fused gates of each ended run go
+    ended = []    # the gates of each ended run, in order
+
+    for gate in gate_lst:
+        fusable = _fusable(gate)
+        if fusable is not None:
+            qbit = fusable[1][0]
+            run = runs.setdefault(qbit, [])
+            run.append(fusable)
+            if len(run) > max_run:
+                runs[qbit] = _fuse_runs([run])[0]
+            continue
+
+        for qbit in gate[1]:  # any other gate ends the runs on its qbits
+            run = runs.pop(qbit, None)
+            if run:
+                placed.append(None)
+                ended.append(run)
+        placed.append(gate)
+
+        if len(placed) >= chunksize:
+            yield from _fuse_placed(placed, ended)
+            placed, ended = [], []
+
+    for qbit in sorted(runs):  # whatever is left at the end of the circuit
+        if runs[qbit]:         # a run fused early into the identity leaves nothing behind
+            placed.append(None)
+            ended.append(runs[qbit])
+    yield from _fuse_placed(placed, ended)
+
+
+def _fuse_placed(placed, runs):
+    """ yields the gates of placed, with each None replaced by the fused rotations of the next run """
+    fused = iter(_fuse_runs(runs))
+    for gate in placed:
+        if gate is None:
+            yield from next(fused)
+        else:
+            yield gate
+
+
+def _fuse_runs(runs):
+    """ returns the list of (at most three) rotation gates replacing each run of single qbit gates """
+
+    if not runs:
+        return []
+
+    lengths = np.array([len(run) for run in runs])
+    gates = [gate for run in runs for gate in run]
+    matrices = _single_qbit_matrices([gate[0] for gate in gates],
+                                     [float(gate[2][0]) if gate[2] else 0.0 for gate in gates])
+    products = _run_products(matrices, lengths)
+
+    angles = np.stack(euler_zxz(products)[::-1], axis=1)  # the angles (c, b, a) in the order the gates are applied
+    keep = _nonzero_angles(angles)
+
+    fused = []
+    for run, run_angles, run_keep in zip(runs, angles.tolist(), keep.tolist()):
+        if len(run) == 1 and run[0][0] in ['Rx', 'Rz']:  # already a single rotation
+            fused.append(run)
+            continue
+        qbit_lst = run[0][1]
+        fused.append([(gate_str, qbit_lst, [angle]) for gate_str, angle, kept in
+                      zip(['Rz', 'Rx', 'Rz'], run_angles, run_keep) if kept])
+    return fused
+
+
+def _run_products(matrices, lengths):
+    """
+    Multiplies the 2x2 unitaries of each run of gates together (in the order they are applied).
+    Step k multiplies in the k'th gate of every run with more than k gates, so the number of
+    numpy calls only grows with the length of the longest run.
+
+    :param matrices: complex array, shape (..., num_gates, 2, 2), the gates of every run one after the other
+    :param lengths: array of ints, the number of gates in each run
+    :return: complex array, shape (..., num_runs, 2, 2)
+    """
+
+    lengths = np.asarray(lengths)
+    starts = np.cumsum(lengths) - lengths
+    by_length = np.argsort(-lengths, kind='stable')
+
+    products = np.broadcast_to(np.eye(2, dtype=complex), matrices.shape[:-3] + (len(lengths), 2, 2)).copy()
+    for k in range(lengths.max(initial=0)):
+        active = by_length[:np.count_nonzero(lengths > k)]
+        products[..., active, :, :] = matrices[..., starts[active] + k, :, :] @ products[..., active, :, :]
+    return products
+
+
+def _nonzero_angles(angles):
+    """ the vectorized (negated) _is_zero_angle, True where an angle is not 0 (mod 2pi) """
+    remainder = np.remainder(angles, 2 * np.pi)
+    return np.minimum(remainder, 2 * np.pi - remainder) > zero_angle_atol
+
+
+def _single_qbit_matrices(gate_strs, angles):
+    """ the 2x2 unitaries of a batch of single qbit gates, shape (num_gates, 2, 2) """
+
+    gate_strs = np.array(gate_strs)
+    half = np.asarray(angles, dtype=np.float64) / 2
+    cos, sin, phase = np.cos(half), np.sin(half), np.exp(-1j * half)
+
+    matrices = np.zeros((len(gate_strs), 2, 2), dtype=complex)
+    for gate_str, matrix in fixed_matrices.items():
+        matrices[gate_strs == gate_str] = matrix
+
+    rx, ry, rz = gate_strs == 'Rx', gate_strs == 'Ry', gate_strs == 'Rz'
+    matrices[rx] = np.stack([cos[rx], -1j * sin[rx], -1j * sin[rx], cos[rx]], axis=-1).reshape(-1, 2, 2)
+    matrices[ry] = np.stack([cos[ry], -sin[ry], sin[ry], cos[ry]], axis=-1).reshape(-1, 2, 2)
+    matrices[rz, 0, 0] = phase[rz]
+    matrices[rz, 1, 1] = phase[rz].conj()
+    return matrices
+
+
+def euler_zxz(matrices):
+    """
+    Finds the ZXZ Euler angles of a batch of 2x2 unitaries U = e^(i phi) Rz(a) Rx(b) Rz(c).
+    Each U is first scaled to have determinant 1, then (writing V for the scaled U):
+    b = 2 atan2(|V10|, |V00|), a = angle(V11) + angle(i V10), c = angle(V11) - angle(i V10).
+    If b is 0 (or pi) only a + c (or a - c) matters, and c is set to 0.
+
+    :param matrices: complex array, shape (num_matrices, 2, 2)
+    :return: a, b, c: arrays of floats, a and c in [-pi, pi) and b in [0, pi]
+    """
+
+    matrices = matrices / np.sqrt(np.linalg.det(matrices))[:, np.newaxis, np.newaxis]
+    diag, off_diag = matrices[:, 1, 1], 1j * matrices[:, 1, 0]
+
+    b = 2 * np.arctan2(np.abs(off_diag), np.abs(matrices[:, 0, 0]))
+    sum_angle, diff_angle = np.angle(diag), np.angle(off_diag)
+
+    tiny = zero_angle_atol / 2
+    diff_angle = np.where(np.abs(off_diag) < tiny, sum_angle, diff_angle)  # b = 0, a single Rz(a + c)
+    sum_angle = np.where(np.abs(diag) < tiny, diff_angle, sum_angle)      # b = pi, only a - c matters
+
+    a = np.remainder(sum_angle + diff_angle + np.pi, 2 * np.pi) - np.pi  # wrapping only changes the phase
+    c = np.remainder(sum_angle - diff_angle + np.pi, 2 * np.pi) - np.pi
+    return a, b, c
+
+
+def _read(circ):
+    """ returns the gate_lst and num_qbits of a qiskit.QuantumCircuit or a GateIR """
+    if isinstance(circ, utils.GateIR):
+        return circ.to_gate_lst(), circ.num_qbits
+    return utils.read_circ(circ)
+
+
+def _write(gate_lst, num_qbits, circ):
+    """ builds the output in the same form as the input circ (qiskit.QuantumCircuit or GateIR),
+    gate_lst can be any iterable of gate tuples """
+    if isinstance(circ, utils.GateIR):
+        return utils.GateIR.from_gate_lst(list(gate_lst), num_qbits)
+    return utils.write_circ(gate_lst, num_qbits)
+
+
+class RoutingTable:
+    """
+    All pairs shortest paths over a coupling graph (topology). dist[a, b] is the number of
+    edges between qbits a and b (-1 if they are not connected) and toward[b, a] is the neighbour
+    of a which is one step closer to b. These are computed once (a BFS from every qbit) and
+    up to max_memoized_paths paths are memoized, so most lookups afterwards are O(1).
+    """
+
+    __slots__ = ('dist', 'toward', 'paths')
+
+    def __init__(self, topology):
+        num_nodes = max(max(topology), max((max(nbrs) for nbrs in topology.values() if nbrs), default=0)) + 1
+        self.dist = np.full((num_nodes, num_nodes), -1, dtype=np.int32)
+        self.toward = np.full((num_nodes, num_nodes), -1, dtype=np.int32)
+        self.paths = {}
+
+        for source in topology:               # BFS from each qbit
+            dist, toward = self.dist[source], self.toward[source]
+            dist[source] = 0
+            toward[source] = source
+            queue = deque([source])
+
+            while queue:
+                current = queue.popleft()
+                for nbr in topology.get(current, ()):
+                    if dist[nbr] < 0:
+                        dist[nbr] = dist[current] + 1
+                        toward[nbr] = current       # one step from nbr back toward the source
+                        queue.append(nbr)
+
+    def path(self, start, end):
+        """ returns the shortest path from end --> start as a list of qbit indicies """
+        key = (start, end)
+        path = self.paths.get(key)
+
+        if path is None:
+            if self.dist[start, end] < 0:
+                raise ValueError('qbits {} and {} are not connected in the topology'.format(start, end))
+
+            path = [end]
+            toward = self.toward[start]
+            while path[-1] != start:                  # walk back toward start one neighbour at a time
+                path.append(int(toward[path[-1]]))
+            if len(self.paths) < max_memoized_paths:  # bound the memory held by a long lived table
+                self.paths[key] = path
+
+        return list(path)
+
+
+max_memoized_paths = 4096  # per RoutingTable, later paths are rebuilt from toward on every lookup
+max_routing_tables = 16    # RoutingTables kept in _routing_tables, the least recently used is dropped
+_routing_tables = OrderedDict()  # topology (as a hashable key) --> RoutingTable, least recently used first
+
+
+def get_routing_table(topology):
+    """
+    Returns the (cached) RoutingTable for a topology. The topology is a dict
+    mapping each qbit index to the list of qbits it is connected to, it can be
+    any coupling graph (ring, line, grid, heavy-hex, ...). The tables of the
+    max_routing_tables most recently used topologies are kept.
+
+    :param topology: dict, {qbit: [connected qbits]}
+    :return: RoutingTable
+    """
+
+    key = topology_key(topology)
+    table = _routing_tables.get(key)
+
+    if table is None:
+        table = RoutingTable(topology)
+        _routing_tables[key] = table
+        if len(_routing_tables) > max_routing_tables:  # evict the least recently used table
+            _routing_tables.popitem(last=False)
     else:
-        return path_ccw
+        _routing_tables.move_to_end(key)
+
+    return table
+
+
+def topology_key(topology):
+    """ returns a hashable version of the topology dict """
+    return tuple(sorted((qbit, tuple(nbrs)) for qbit, nbrs in topology.items()))
+
+
+def get_path(topology, start, end):
+    """ Takes a dict (topology) representing the geometry of the
+    connections, an int (start) representing the starting index
+    and an int (end) representing the ending index and returns
+    a list corresponding to the shortest path from end --> start
+    (over any connected topology) """
+
+    return get_routing_table(topology).path(start, end)
 
 
 def get_swaps(path):
@@ -207,35 +786,134 @@ def get_swaps(path):
 
 
 def circ_router(circ, topology):
-    """ Takes a compiled circuit, and a topology to produce a
-    properly routed circuit. """
+    """ Takes a compiled circuit (qiskit.QuantumCircuit or GateIR),
+    and a topology to produce a properly routed circuit. """
 
-    gate_lst, num_qbits = utils.read_circ(circ)
+    if isinstance(circ, utils.GateIR):
+        gates, num_qbits = iter(circ), circ.num_qbits
+    else:
+        gates, num_qbits = utils.iter_circ(circ), circ.num_qubits
+
+    compiled_circ = _write(route_gates(gates, topology), num_qbits, circ)  # stream the routed gates into the output
+
+    return compiled_circ
+
+
+def route_gates(gate_lst, topology):
+    """ Takes a list (or any iterable) of gate tuples from a compiled circuit, and a
+    topology and yields the gate tuples of the properly routed circuit in a single pass.
+    Every Cz between unconnected qbits is replaced by the swaps which bring the target
+    next to the control, the Cz and the swaps which move it back. """
 
-    for index, gate in enumerate(gate_lst):  # iterate through the circuit
-        curr_gate_str = gate_lst[index][0]
-        curr_qbit_lst = gate_lst[index][1]
-        curr_parms = gate_lst[index][2]
+    table = get_routing_table(topology)  # shortest paths are computed once per topology
+
+    for gate in gate_lst:  # iterate through the circuit
+        curr_gate_str = gate[0]
+        curr_qbit_lst = gate[1]
+        curr_parms = gate[2]
 
         if curr_gate_str == 'Cz':  # check if this gate is a cz gate
             cntrl_qbit = curr_qbit_lst[0]
             trgt_qbit = curr_qbit_lst[1]
 
             if not (trgt_qbit in topology[cntrl_qbit]):  # check if the control and target qbits are 'connected'
-                new_target = topology[cntrl_qbit][1]  # if not, choose a qbit that is connected to the control
+                new_target = min(topology[cntrl_qbit], key=lambda qbit: table.dist[qbit, trgt_qbit])
+                # if not, choose the qbit connected to the control which is closest to the target
                 # to be the new target qbit
-                path = get_path(topology, new_target,
-                                trgt_qbit)  # find the path between the new target and the old target
-                first_swaps = get_swaps(path)  # the swap gates required to swap new_target w/ old target
+                path = table.path(new_target, trgt_qbit)  # find the path between the new target and the old target
+                yield from get_swaps(path)  # the swap gates required to swap new_target w/ old target
+                yield curr_gate_str, [cntrl_qbit, new_target], curr_parms
                 path.reverse()
-                swap_backs = get_swaps(path)  # the swap gates required to swap them back to original
+                yield from get_swaps(path)  # the swap gates required to swap them back to original
+                continue
+
+        yield gate
+
+
+def layout_router(circ, topology, initial_layout=None, lookahead=20, lookahead_weight=0.5):
+    """ Takes a compiled circuit (qiskit.QuantumCircuit or GateIR) and a topology to produce
+    a properly routed circuit, without swapping the qbits back after every gate. Instead we keep
+    track of where each (logical) qbit of the circuit currently lives on the device (physical qbit),
+    and only add the swaps needed to make each two qbit gate act on connected qbits. The swaps
+    are picked (SABRE style) by how much closer they bring the qbits of the current gate together,
+    plus how much closer they bring the qbits of the next few two qbit gates (the lookahead).
+
+    :param circ: compiled qiskit.QuantumCircuit object (or a GateIR)
+    :param topology: dict, {qbit: [connected qbits]}
+    :param initial_layout: optional list, initial_layout[logical qbit] = physical qbit (identity by default)
+    :param lookahead: int, the number of upcoming two qbit gates used to score each swap
+    :param lookahead_weight: float, the weight of the lookahead term relative to the current gate
+    :return: routed_circ, final_layout: routed circuit on the physical qbits and a list where
+             final_layout[logical qbit] = physical qbit at the end of the circuit
+    """
 
-                replacement_lst = first_swaps + [(curr_gate_str, [cntrl_qbit, new_target], curr_parms)] + swap_backs
+    gate_lst, num_qbits = _read(circ)
+    table = get_routing_table(topology)
+    num_phys = max(num_qbits, table.dist.shape[0])
 
-                del gate_lst[index]  # we delete the old Cz gate
-                for j, replacement in enumerate(replacement_lst):  # and add the swap + cz gate + swap back gates
-                    gate_lst.insert(index + j, replacement)
+    layout = list(range(num_qbits)) if initial_layout is None else list(initial_layout)  # logical --> physical
+    occupant = [-1] * num_phys                                                            # physical --> logical
+    for logical, physical in enumerate(layout):
+        occupant[physical] = logical
 
-    compiled_circ = utils.write_circ(gate_lst, num_qbits)  #
+    two_qbit_gates = [gate[1] for gate in gate_lst if len(gate[1]) == 2]  # upcoming logical qbit pairs
+    next_two_qbit = 0
 
-    return compiled_circ
+    new_gate_lst = []
+    for gate_str, qbit_lst, parms in gate_lst:
+
+        if len(qbit_lst) == 2:
+            next_two_qbit += 1
+            window = two_qbit_gates[next_two_qbit:next_two_qbit + lookahead]
+            qbit1, qbit2 = qbit_lst
+
+            if table.dist[layout[qbit1], layout[qbit2]] < 0:
+                raise ValueError('qbits {} and {} are not connected in the topology'.format(qbit1, qbit2))
+
+            while table.dist[layout[qbit1], layout[qbit2]] > 1:  # the qbits are not connected yet
+                swap = _best_swap(table, topology, layout, qbit1, qbit2, window, lookahead_weight)
+                new_gate_lst.append(('S', list(swap), []))
+
+                phys1, phys2 = swap  # update the layout
+                log1, log2 = occupant[phys1], occupant[phys2]
+                occupant[phys1], occupant[phys2] = log2, log1
+                if log1 >= 0:
+                    layout[log1] = phys2
+                if log2 >= 0:
+                    layout[log2] = phys1
+
+        new_gate_lst.append((gate_str, [layout[qbit] for qbit in qbit_lst], parms))
+
+    routed_circ = _write(new_gate_lst, num_phys, circ)
+
+    return routed_circ, layout
+
+
+def _best_swap(table, topology, layout, qbit1, qbit2, window, lookahead_weight):
+    """ returns the (physical) swap which brings qbit1 and qbit2 closer together while
+    keeping the qbits of the gates in the lookahead window as close as possible """
+
+    dist = table.dist
+    phys1, phys2 = layout[qbit1], layout[qbit2]
+    current = dist[phys1, phys2]
+
+    best_swap, best_score = None, None
+    for phys in (phys1, phys2):
+        for nbr in topology[phys]:
+            moved = {phys: nbr, nbr: phys}  # where each physical qbit ends up after this swap
+
+            new_dist = dist[moved.get(phys1, phys1), moved.get(phys2, phys2)]
+            if new_dist >= current:         # only consider swaps which make progress on the current gate
+                continue
+
+            score = float(new_dist)
+            if window:
+                total = 0
+                for log1, log2 in window:
+                    total += dist[moved.get(layout[log1], layout[log1]), moved.get(layout[log2], layout[log2])]
+                score += lookahead_weight * total / len(window)
+
+            if best_score is None or score < best_score:
+                best_swap, best_score = (phys, nbr), score
+
+    return best_swap
@@ -0,0 +1,148 @@
+# Depth aware scheduling, groups the gates of a circuit into layers (moments) of parallel gates
+from . import comp_utils as utils
+import numpy as np
+
+# The basis each gate is diagonal in, for each of its qbits (in order). Two gates which share qbits
+# commute if they are diagonal in the same basis on every qbit they share, eg. Rz and the control of
+# a Cx, or Rx and the target of a Cx. Gates which are not listed (H, Y, Ry, S) commute with nothing.
+gate_bases = {'I': ['z'], 'Z': ['z'], 'Rz': ['z'], 'X': ['x'], 'Rx': ['x'], 'Cz': ['z', 'z'], 'Cx': ['z', 'x']}
+schedule_modes = ['asap', 'alap']
+
+
+def asap_layers(gate_lst, commute=True):
+    """
+    Assigns every gate to the earliest layer it can go in (as soon as possible), in a single
+    sweep with a frontier per qbit. Each layer acts on every qbit at most once. If commute is
+    True, a gate may also be moved ahead of earlier gates it commutes with (see gate_bases):
+    for each qbit we keep the current block of commuting gates on it, and a gate belonging to
+    that block only has to come after the gates before the block. The layers already taken by
+    a block are skipped with path compressed 'next free layer' pointers, so each gate is placed
+    in amortized constant time.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param commute: bool, if False the gates on each qbit keep their order
+    :return: array of ints, the layer (starting at 0) of each gate
+    """
+
+    layers = []
+    basis = {}    # qbit --> basis of the block of commuting gates on that qbit
+    barrier = {}  # qbit --> last layer used on that qbit before its block started
+    top = {}      # qbit --> last layer used on that qbit
+    used = {}     # qbit --> {layer used by the block on that qbit: a later layer to look for a free one at}
+
+    for gate in gate_lst:
+        qbit_lst = gate[1]
+        bases = gate_bases.get(gate[0]) if commute else None
+
+        layer = 0
+        joins = []  # whether the gate joins the block on each of its qbits
+        for index, qbit in enumerate(qbit_lst):
+            gate_basis = bases[index] if bases else None
+            joined = gate_basis is not None and basis.get(qbit) == gate_basis
+            joins.append(joined)
+            layer = max(layer, (barrier[qbit] if joined else top.get(qbit, -1)) + 1)
+
+        while True:  # skip the layers taken by the blocks the gate joins, until one is free on all of them
+            free = layer
+            for qbit, joined in zip(qbit_lst, joins):
+                if joined:
+                    free = _next_free(used[qbit], free)
+            if free == layer:
+                break
+            layer = free
+
+        for index, qbit in enumerate(qbit_lst):
+            if joins[index]:
+                used[qbit][layer] = layer + 1
+                top[qbit] = max(top[qbit], layer)
+            else:                                  # start a new block on this qbit
+                barrier[qbit] = top.get(qbit, -1)
+                basis[qbit] = bases[index] if bases else None
+                used[qbit] = {layer: layer + 1}
+                top[qbit] = layer
+
+        layers.append(layer)
+
+    return np.array(layers, dtype=np.int64)
+
+
+def _next_free(used, layer):
+    """ the first layer >= layer which is not in used, the layers passed on the way are pointed straight at it """
+    passed = []
+    while layer in used:
+        passed.append(layer)
+        layer = used[layer]
+    for taken in passed:
+        used[taken] = layer
+    return layer
+
+
+def alap_layers(gate_lst, commute=True):
+    """
+    Assigns every gate to the latest layer it can go in (as late as possible), by scheduling
+    the reversed circuit as soon as possible. See asap_layers.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param commute: bool, if False the gates on each qbit keep their order
+    :return: array of ints, the layer (starting at 0) of each gate
+    """
+
+    layers = asap_layers(reversed(list(gate_lst)), commute)[::-1]
+    return layers.max(initial=-1) - layers
+
+
+def get_layers(gate_lst, mode='asap', commute=True):
+    """ the layer of each gate, scheduled as soon ('asap') or as late ('alap') as possible """
+    if mode not in schedule_modes:
+        raise ValueError("mode must be one of {}, got '{}'".format(schedule_modes, mode))
+    return asap_layers(gate_lst, commute) if mode == 'asap' else alap_layers(gate_lst, commute)
+
+
+def schedule(gate_lst, mode='asap', commute=True):
+    """
+    Reorders the gates layer by layer (the gates within a layer keep their relative order),
+    so the circuit is written out one moment of parallel gates at a time.
+
+    :param gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param mode: str, 'asap' or 'alap'
+    :param commute: bool, if True commuting gates may be reordered to shorten the circuit
+    :return: new_gate_lst: the reordered list (or a GateIR if a GateIR was given)
+    """
+
+    order = np.argsort(get_layers(gate_lst, mode, commute), kind='stable')
+
+    if isinstance(gate_lst, utils.GateIR):
+        return utils.GateIR(gate_lst.ops[order], gate_lst.qbits[order], gate_lst.params[order], gate_lst.num_qbits)
+    return [gate_lst[index] for index in order]
+
+
+def moments(gate_lst, mode='asap', commute=True):
+    """
+    Groups the gates into moments, lists of gates acting on different qbits which can all be applied at once.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param mode: str, 'asap' or 'alap'
+    :param commute: bool, if True commuting gates may be reordered to shorten the circuit
+    :return: list of lists of gate tuples, one list per layer
+    """
+
+    gate_lst = list(gate_lst)
+    layers = get_layers(gate_lst, mode, commute)
+
+    grouped = [[] for _ in range(layers.max(initial=-1) + 1)]
+    for gate, layer in zip(gate_lst, layers):
+        grouped[layer].append(gate)
+    return grouped
+
+
+def depth(gate_lst, commute=True):
+    """
+    The depth of a circuit (its number of layers) once commuting gates are taken into account,
+    with commute=False this is the same as utils.circuit_depth.
+
+    :param gate_lst: a list (or any iterable) containing tuples eg. ('gate_str', [qbits], [params]), or a GateIR
+    :param commute: bool, if True commuting gates may be reordered to shorten the circuit
+    :return: int, depth
+    """
+
+    return int(asap_layers(gate_lst, commute).max(initial=-1)) + 1
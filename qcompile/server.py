@@ -0,0 +1,348 @@
+# Compile server, keeps the compiler running as a long lived process which takes requests as json lines
+#
+# Example:
+#   python -m qcompile.server                                   (requests on stdin, responses on stdout)
+#   python -m qcompile.server --socket /tmp/qcompile.sock --workers 4
+#   python -m qcompile.server --port 8765
+#
+# Each request is a json object on its own line, holding the circuit either as an OpenQASM 2 program
+# or as a gate list (and its number of qbits), and optionally the compiler mode and a topology to route on:
+#   {"id": 1, "qasm": "OPENQASM 2.0; ...", "mode": "compiler", "topology": {"0": [1], "1": [0, 2], "2": [1]}}
+#   {"id": 2, "gates": [["H", [0], []], ["Rx", [1], [0.5]], ["Cx", [0, 1], []]], "num_qbits": 2}
+#   {"id": 3, "op": "metrics"}
+# Every response is a json line with the id of its request and the compiled circuit in the same form
+# ("qasm", or "gates" and "num_qbits"), the server "metrics", or an "error". Responses are written as
+# soon as they are ready, so they can come back in a different order than the requests were sent.
+#
+# Requests which arrive close together are collected into micro batches (of at most --max-batch
+# requests, waiting at most --max-delay seconds for more to arrive) and sent to the pool of worker
+# processes a chunk at a time. The workers live as long as the server, so the routing table of each
+# topology (see qcomp.get_routing_table) is built once per worker and reused by later requests. Each
+# worker keeps the tables of the qcomp.max_routing_tables most recently used topologies, so clients
+# sending many different topologies don't make its memory grow without bound.
+from . import passes
+from . import qasm
+from . import qcomp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import asyncio
+import bisect
+import json
+import math
+import numbers
+import os
+import sys
+import time
+
+latency_buckets_ms = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]  # histogram upper bounds
+max_line_bytes = 2 ** 26  # longest request line accepted on a socket
+gate_shapes = {'I': (1, 0), 'H': (1, 0), 'X': (1, 0), 'Y': (1, 0), 'Z': (1, 0), 'Rx': (1, 1), 'Ry': (1, 1),
+               'Rz': (1, 1), 'Cx': (2, 0), 'Cz': (2, 0), 'S': (2, 0)}  # gate_str --> (num qbits, num params)
+
+
+class CompileServer:
+    """
+    Queues compile requests (dicts, see the top of this file), groups them into micro batches
+    and compiles them on a pool of worker processes (workers=1 compiles in a thread of this
+    process instead). Call start() from inside the event loop before handling requests, and
+    stop() when done. metrics() returns the request counters, the queue depth and a histogram
+    of the request latencies (from the moment a request is handled to its response).
+    """
+
+    def __init__(self, workers=None, max_batch=32, max_delay=0.002):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.in_flight = 0           # requests being compiled right now
+        self.max_queue_depth = 0
+        self.total_latency_ms = 0.0
+        self.latency_counts = [0] * (len(latency_buckets_ms) + 1)  # the last bucket is everything slower
+
+        self._queue = None
+        self._executor = None
+        self._batcher = None
+        self._slots = None
+        self._tasks = set()
+
+    async def start(self):
+        """ creates the worker pool and starts collecting requests into batches """
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(2 * self.workers)  # max number of chunks being compiled at once
+        if self.workers == 1:
+            self._executor = ThreadPoolExecutor(1)
+        else:
+            self._executor = ProcessPoolExecutor(self.workers)
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        """ stops the batching and shuts the worker pool down (requests still queued are dropped) """
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+    async def handle(self, request):
+        """
+        Compiles a single request.
+
+        :param request: dict, the request (see the top of this file)
+        :return: dict, the response
+        """
+
+        if request.get('op') == 'metrics':
+            return {'id': request.get('id'), 'metrics': self.metrics()}
+
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((request, future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+        response = await future
+        self._record(1000 * (time.perf_counter() - start), 'error' in response)
+        return {'id': request.get('id'), **response}
+
+    def metrics(self):
+        """ returns a dict with the request counters, queue depth and latency histogram """
+        histogram = {str(bound): count for bound, count in zip(latency_buckets_ms, self.latency_counts)}
+        histogram['+inf'] = self.latency_counts[-1]
+        return {'requests': self.requests, 'errors': self.errors, 'batches': self.batches,
+                'mean_batch_size': self.batched_requests / self.batches if self.batches else 0.0,
+                'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+                'max_queue_depth': self.max_queue_depth, 'in_flight': self.in_flight, 'workers': self.workers,
+                'mean_latency_ms': self.total_latency_ms / self.requests if self.requests else 0.0,
+                'latency_histogram_ms': histogram}
+
+    def _record(self, latency_ms, error):
+        self.requests += 1
+        self.errors += error
+        self.total_latency_ms += latency_ms
+        self.latency_counts[bisect.bisect_left(latency_buckets_ms, latency_ms)] += 1
+
+    async def _batch_loop(self):
+        """ takes the queued requests a batch at a time and hands them out to the workers """
+
+        while True:
+            batch = [await self._queue.get()]
+            self._drain(batch)
+            if len(batch) < self.max_batch and self.max_delay > 0:  # give other requests a moment to arrive
+                await asyncio.sleep(self.max_delay)
+                self._drain(batch)
+
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+            # keep requests with the same mode and topology together, and split the batch over the workers
+            batch.sort(key=lambda item: (str(item[0].get('mode')), str(item[0].get('topology'))))
+            chunksize = math.ceil(len(batch) / self.workers)
+            for index in range(0, len(batch), chunksize):
+                await self._slots.acquire()
+                task = asyncio.create_task(self._dispatch(batch[index:index + chunksize]))
+                self._tasks.add(task)  # the loop only keeps weak references to its tasks
+                task.add_done_callback(self._tasks.discard)
+
+    def _drain(self, batch):
+        """ moves queued requests into the batch (without waiting) until it is full """
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+    async def _dispatch(self, chunk):
+        """ compiles a chunk of requests on the pool, and passes each response to its future """
+
+        self.in_flight += len(chunk)
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(
+                self._executor, compile_requests, [request for request, _ in chunk])
+        except Exception as error:  # eg. a worker process died
+            responses = [{'error': _error_str(error)} for _ in chunk]
+        finally:
+            self.in_flight -= len(chunk)
+            self._slots.release()
+
+        for (_, future), response in zip(chunk, responses):
+            if not future.done():
+                future.set_result(response)
+
+
+def compile_requests(requests):
+    """ compiles a list of requests, this runs in the worker processes """
+    responses = []
+    for request in requests:
+        try:
+            responses.append(compile_request(request))
+        except Exception as error:
+            responses.append({'error': _error_str(error)})
+    return responses
+
+
+def compile_request(request):
+    """
+    Compiles (and optionally routes) the circuit of a single request.
+
+    :param request: dict, with a 'qasm' str or a 'gates' list (and 'num_qbits'), and optionally
+                    a 'mode' ('compiler' or 'simple') and a 'topology' ({qbit: [connected qbits]})
+    :return: dict, the response, with the compiled 'qasm' or 'gates' and 'num_qbits'
+    """
+
+    mode = request.get('mode', 'compiler')
+    if mode not in qasm.qasm_compile_modes:
+        raise ValueError("mode must be one of {}, got '{}'".format(list(qasm.qasm_compile_modes), mode))
+
+    topology = request.get('topology')
+    if topology is not None:  # json keys are always strings
+        topology = {int(qbit): [int(nbr) for nbr in nbrs] for qbit, nbrs in topology.items()}
+
+    if 'qasm' in request:
+        return {'qasm': qasm.compile_qasm(request['qasm'], mode, topology)}
+
+    if 'gates' not in request:
+        raise ValueError("a request needs either 'qasm' or 'gates'")
+
+    gate_lst = [_read_gate(gate) for gate in request['gates']]
+    num_qbits = max(request.get('num_qbits', 0), passes._num_qbits(gate_lst))
+
+    gate_lst = qasm.qasm_compile_modes[mode](gate_lst)
+    if topology is not None:
+        gate_lst = list(qcomp.route_gates(gate_lst, topology))
+        num_qbits = max(num_qbits, qcomp.get_routing_table(topology).dist.shape[0])
+
+    return {'gates': [[gate_str, qbit_lst, [float(param) for param in params]]
+                      for gate_str, qbit_lst, params in gate_lst], 'num_qbits': num_qbits}
+
+
+def _read_gate(gate):
+    """ returns a gate tuple ('gate_str', [qbits], [params]) from a request, checking it has the right shape """
+
+    if not isinstance(gate, (list, tuple)) or len(gate) != 3:
+        raise ValueError('a gate must be [gate_str, [qbits], [params]], got {!r}'.format(gate))
+    gate_str, qbit_lst, params = gate
+    if gate_str not in gate_shapes:
+        raise ValueError("unknown gate '{}'".format(gate_str))
+
+    num_qbits, num_params = gate_shapes[gate_str]
+    if (not isinstance(qbit_lst, (list, tuple)) or len(qbit_lst) != num_qbits
+            or not all(isinstance(qbit, numbers.Integral) and not isinstance(qbit, bool) and qbit >= 0
+                       for qbit in qbit_lst) or len(set(qbit_lst)) != num_qbits):
+        raise ValueError("bad gate {!r}, '{}' takes {} distinct qbit index(es)".format(gate, gate_str, num_qbits))
+    if (not isinstance(params, (list, tuple)) or len(params) != num_params
+            or not all(isinstance(param, numbers.Real) and not isinstance(param, bool) for param in params)):
+        raise ValueError("bad gate {!r}, '{}' takes {} number param(s)".format(gate, gate_str, num_params))
+
+    return gate_str, [int(qbit) for qbit in qbit_lst], list(params)
+
+
+def _error_str(error):
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+async def serve_lines(server, readline, write):
+    """
+    Answers json line requests until readline returns an empty line (the end of the input).
+    Every request is handled in its own task, so many can be waiting on the server at once.
+
+    :param server: CompileServer (started)
+    :param readline: coroutine func returning the next line (bytes), or b'' at the end
+    :param write: coroutine func taking a response line (bytes)
+    """
+
+    tasks = set()
+
+    async def answer(line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a json object')
+        except ValueError as error:
+            response = {'id': None, 'error': _error_str(error)}
+        else:
+            response = await server.handle(request)
+        await write((json.dumps(response) + '\n').encode())
+
+    while True:
+        line = await readline()
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.create_task(answer(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+async def serve_stdio(server):
+    """ answers the requests read from stdin, writing the responses to stdout """
+    loop = asyncio.get_running_loop()
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+
+    async def readline():  # read in a thread, this works whether stdin is a pipe, a file or a terminal
+        return await loop.run_in_executor(None, stdin.readline)
+
+    async def write(line):
+        stdout.write(line)
+        stdout.flush()
+
+    await serve_lines(server, readline, write)
+
+
+async def serve_socket(server, path=None, port=None):
+    """ answers the requests of every client connecting to a unix socket (path) or a local tcp port """
+
+    async def client(reader, writer):
+        async def write(line):
+            writer.write(line)
+            await writer.drain()
+
+        try:
+            await serve_lines(server, reader.readline, write)
+        finally:
+            writer.close()
+
+    if path is not None:
+        listener = await asyncio.start_unix_server(client, path, limit=max_line_bytes)
+    else:
+        listener = await asyncio.start_server(client, '127.0.0.1', port, limit=max_line_bytes)
+
+    async with listener:
+        await listener.serve_forever()
+
+
+async def run(args):
+    server = CompileServer(args.workers, args.max_batch, args.max_delay)
+    await server.start()
+    try:
+        if args.socket is not None or args.port is not None:
+            await serve_socket(server, args.socket, args.port)
+        else:
+            await serve_stdio(server)
+    finally:
+        await server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the compiler as a server taking json line requests.')
+    parser.add_argument('--socket', help='path of a unix socket to listen on (default: stdin / stdout)')
+    parser.add_argument('--port', type=int, help='local tcp port to listen on (default: stdin / stdout)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: every cpu, 1 compiles in the server process)')
+    parser.add_argument('--max-batch', type=int, default=32, help='max number of requests in a batch')
+    parser.add_argument('--max-delay', type=float, default=0.002,
+                        help='seconds to wait for more requests before sending a batch off')
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,365 @@
+# Compiled circuit templates, compile a circuit structure once and re-bind its parameters
+from . import comp_utils as utils
+from . import qcomp
+import numbers
+import numpy as np
+
+template_modes = {'compiler': qcomp.compile_gates, 'simple': qcomp.simple_compile_gates}
+
+
+class CircuitTemplate:
+    """
+    A compiled circuit whose angles are linear functions of the parameters of the
+    original circuit. The gates are stored as a GateIR (skeleton) whose params hold the
+    constant part of each angle, and the parameter dependence is stored as a sparse
+    matrix in (rows, cols, coeffs) form: angle[rows[k]] += coeffs[k] * values[cols[k]].
+    For a circuit with (qiskit) Parameters, param_names holds the names of the parameters
+    in order, otherwise the parameters are the angles of its Rx, Ry and Rz gates (in order)
+    and param_names is None.
+
+    The fuse_rotations pass of the compiler needs numeric angles, so runs containing a symbolic
+    angle are not fused in the template, and a bound template has more single qbit gates than
+    the compiler would give for the same circuit. Bind with fuse=True to fuse the bound circuits:
+    the runs of single qbit gates (and the chains of runs only separated by Cz gates, which a
+    trailing Rz can be merged through) only depend on the skeleton, so they are found once
+    (see fusion_plan) and the runs of every binding are then fused in one batch.
+    """
+
+    __slots__ = ('skeleton', 'num_params', 'rows', 'cols', 'coeffs', 'param_names', '_fusion_plan')
+
+    def __init__(self, skeleton, num_params, rows, cols, coeffs, param_names=None):
+        self.skeleton = skeleton
+        self.num_params = num_params
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+        self.param_names = param_names
+        self._fusion_plan = None
+
+    def bind(self, values, fuse=False):
+        """
+        Evaluates the template for one set of parameter values.
+
+        :param values: array of floats, one per parameter, or a dict {Parameter (or name): float}
+        :param fuse: bool, if True the single qbit gates of the bound circuit are fused, like the
+                     fuse_rotations and merge_rotations passes would
+        :return: GateIR, the compiled circuit
+        """
+
+        return self.bind_many(self._as_array(values)[np.newaxis], fuse)[0]
+
+    def bind_many(self, values, fuse=False):
+        """
+        Evaluates the template for a whole batch of parameter values at once.
+
+        :param values: 2d array of floats, shape (num_bindings, num_params)
+        :param fuse: bool, if True the single qbit gates of each bound circuit are fused (all in one batch)
+        :return: list of GateIR's (one per binding), these share the skeleton's ops and qbits unless fused
+        """
+
+        angles = self.angles(values)
+        skeleton = self.skeleton
+        if fuse:
+            return _bind_fused(self.fusion_plan(), angles, skeleton.num_qbits)
+        return [utils.GateIR(skeleton.ops, skeleton.qbits, row, skeleton.num_qbits) for row in angles]
+
+    def to_gate_lst(self, parameters):
+        """
+        Writes the template out with each angle in terms of qiskit Parameters, the compiled
+        version of a circuit with unbound Parameters (the template has to have named parameters).
+
+        :param parameters: iterable of qiskit Parameters (eg. circ.parameters), matched to the template by name
+        :return: gate_lst: a list containing tuples eg. ('gate_str', [qbits], [params])
+        """
+
+        if self.param_names is None:
+            raise ValueError('this template has no named parameters, bind it with an array of values')
+        by_name = {param.name: param for param in parameters}
+        missing = [name for name in self.param_names if name not in by_name]
+        if missing:
+            raise ValueError('missing parameters {}'.format(missing))
+        parameters = [by_name[name] for name in self.param_names]
+
+        gate_lst = self.skeleton.to_gate_lst()
+        exprs = {}  # gate index --> the parameter dependent part of its angle
+        for row, col, coeff in zip(self.rows.tolist(), self.cols.tolist(), self.coeffs.tolist()):
+            exprs[row] = exprs.get(row, 0.0) + coeff * parameters[col]
+        for row, expr in exprs.items():
+            gate_str, qbit_lst, params = gate_lst[row]
+            gate_lst[row] = (gate_str, qbit_lst, [params[0] + expr])
+        return gate_lst
+
+    def fusion_plan(self):
+        """ returns the runs and chains of runs of the skeleton (see _fusion_plan), found on the first call """
+        if self._fusion_plan is None:
+            self._fusion_plan = _fusion_plan(self.skeleton)
+        return self._fusion_plan
+
+    def angles(self, values):
+        """
+        Computes the params of every compiled gate for a batch of parameter values (vectorized).
+
+        :param values: 2d array of floats, shape (num_bindings, num_params)
+        :return: 2d array of floats, shape (num_bindings, num_gates) (nan for gates without a param)
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 2 or values.shape[1] != self.num_params:
+            raise ValueError('expected values of shape (num_bindings, {}), got {}'.format(self.num_params,
+                                                                                        values.shape))
+
+        angles = np.tile(self.skeleton.params, (len(values), 1))
+        np.add.at(angles.T, self.rows, (values[:, self.cols] * self.coeffs).T)
+        return angles
+
+    def _as_array(self, values):
+        """ converts a dict {Parameter (or name): float} into an array ordered like the parameters """
+        if not isinstance(values, dict):
+            return np.asarray(values, dtype=np.float64)
+
+        if self.param_names is None:
+            raise ValueError('this template has no named parameters, bind it with an array of values')
+        by_name = {getattr(param, 'name', param): value for param, value in values.items()}
+        missing = [name for name in self.param_names if name not in by_name]
+        if missing:
+            raise ValueError('missing values for parameters {}'.format(missing))
+        return np.array([by_name[name] for name in self.param_names], dtype=np.float64)
+
+    def save(self, file):
+        """ writes the template to a .npz file (path or file object) """
+        param_names = np.array([] if self.param_names is None else self.param_names, dtype=str)
+        np.savez(file, ops=self.skeleton.ops, qbits=self.skeleton.qbits, params=self.skeleton.params,
+                 num_qbits=self.skeleton.num_qbits, num_params=self.num_params,
+                 rows=self.rows, cols=self.cols, coeffs=self.coeffs,
+                 named=self.param_names is not None, param_names=param_names)
+
+    @classmethod
+    def load(cls, file):
+        """ reads a template written by save """
+        with np.load(file) as data:
+            skeleton = utils.GateIR(data['ops'], data['qbits'], data['params'], int(data['num_qbits']))
+            param_names = data['param_names'].tolist() if bool(data['named']) else None
+            return cls(skeleton, int(data['num_params']), data['rows'], data['cols'], data['coeffs'], param_names)
+
+
+def compile_template(circ, mode='compiler', topology=None):
+    """
+    Compiles (and optionally routes) a circuit into a CircuitTemplate. Every parameter of
+    the circuit is replaced by a symbolic Angle before compiling, so the result holds for
+    any values of the parameters. If the circuit has (unbound) qiskit Parameters, those are
+    the parameters of the template (each angle has to be linear in them, eg. 2 * theta + 1)
+    and any numeric angles are constants. Otherwise the numeric angles are the parameters.
+
+    :param circ: qiskit.QuantumCircuit object (or a GateIR)
+    :param mode: str, 'compiler' or 'simple' (the compiler or the simple_compiler)
+    :param topology: optional dict, {qbit: [connected qbits]}, if given the circuit is also routed
+    :return: CircuitTemplate (not fused, see CircuitTemplate)
+    """
+
+    if mode not in template_modes:
+        raise ValueError("mode must be one of {}, got '{}'".format(list(template_modes), mode))
+
+    if isinstance(circ, utils.GateIR):
+        gates, num_qbits, parameters = iter(circ), circ.num_qbits, []
+    else:
+        gates, num_qbits, parameters = utils.iter_circ(circ), circ.num_qubits, list(circ.parameters)
+
+    param_index = {param: index for index, param in enumerate(parameters)}
+    num_params = len(parameters)
+
+    gate_lst = []
+    for gate_str, qbit_lst, params in gates:
+        if params and parameters:                             # symbolic circuit, translate the expressions
+            params = [_to_angle(params[0], param_index)]
+        elif params:                                          # swap each numeric angle out for a symbol
+            params = [utils.Angle.param(num_params)]
+            num_params += 1
+        gate_lst.append((gate_str, qbit_lst, params))
+
+    gate_lst = template_modes[mode](gate_lst)
+    if topology is not None:
+        gate_lst = list(qcomp.route_gates(gate_lst, topology))
+
+    param_names = [param.name for param in parameters] if parameters else None
+    return _template_from_gate_lst(gate_lst, num_qbits, num_params, param_names)
+
+
+def _to_angle(expr, param_index):
+    """ translates a (linear) qiskit ParameterExpression into an Angle, numbers are left as floats """
+
+    if isinstance(expr, numbers.Number):
+        return float(expr)
+
+    const = float(expr.bind({param: 0 for param in expr.parameters}))
+    terms = {}
+    for param in expr.parameters:
+        try:
+            terms[param_index[param]] = float(expr.gradient(param))
+        except TypeError:
+            raise ValueError('the angle {} is not linear in its parameters'.format(expr))
+
+    return utils.Angle(const, terms)
+
+
+def _template_from_gate_lst(gate_lst, num_qbits, num_params, param_names=None):
+    """ splits the Angles of a compiled gate_lst into the skeleton and the sparse parameter matrix """
+
+    skeleton_lst = []
+    rows, cols, coeffs = [], [], []
+
+    for index, (gate_str, qbit_lst, params) in enumerate(gate_lst):
+        if params and isinstance(params[0], utils.Angle):
+            for param_index, coeff in params[0].terms.items():
+                rows.append(index)
+                cols.append(param_index)
+                coeffs.append(coeff)
+            params = [params[0].const]
+        skeleton_lst.append((gate_str, qbit_lst, params))
+
+    skeleton = utils.GateIR.from_gate_lst(skeleton_lst, num_qbits)
+    return CircuitTemplate(skeleton, num_params, rows, cols, coeffs, param_names)
+
+
+def _fusion_plan(skeleton):
+    """
+    Finds the runs of single qbit gates in a skeleton, the way fuse_rotations does, and lays
+    out the fused circuit: every run is replaced by the three slots Rz(c) Rx(b) Rz(a), put where
+    its first gate was. The runs on a qbit which are only separated by Cz gates form a chain,
+    merge_rotations would merge the trailing Rz of each run through the Cz gates into the next one.
+
+    :param skeleton: GateIR
+    :return: dict of arrays, 'gates' (the skeleton index of the gates of every run, run after run),
+             'gate_strs' (of those gates), 'lengths' (of the runs), 'order' (the runs chain after chain),
+             then for each run in that order: 'heads' / 'tails' (whether it starts / ends its chain), 'slots'
+             (its first slot), 'firsts' (its first gate) and 'alone_rx' / 'alone_rz' (whether it is a single
+             Rx / Rz), and 'ops', 'qbits' and 'fixed' (the fused layout, and which slots are skeleton gates)
+    """
+
+    ops, qbits = skeleton.ops.tolist(), skeleton.qbits.tolist()
+    rz, rx, cz = utils.gate_op_dict['Rz'], utils.gate_op_dict['Rx'], utils.gate_op_dict['Cz']
+
+    runs = []        # the skeleton indices of the gates of each run
+    previous = []    # the run each run continues the chain of (-1 if it starts a chain)
+    slots = []       # the first slot of each run in the fused layout
+    open_runs = {}   # qbit --> run currently being collected on that qbit
+    chain_ends = {}  # qbit --> last run on that qbit, if only Cz gates have acted on it since
+    new_ops, new_qbits, fixed = [], [], []
+
+    for index, (op, qbit_pair) in enumerate(zip(ops, qbits)):
+        if qbit_pair[1] < 0:                          # a single qbit gate, add it to the run on its qbit
+            qbit = qbit_pair[0]
+            run = open_runs.get(qbit)
+            if run is None:
+                run = open_runs[qbit] = len(runs)
+                runs.append([])
+                previous.append(chain_ends.pop(qbit, -1))
+                slots.append(len(new_ops))
+                new_ops += [rz, rx, rz]
+                new_qbits += [[qbit, -1]] * 3
+                fixed += [False] * 3
+            runs[run].append(index)
+            continue
+
+        for qbit in qbit_pair:                        # any other gate ends the runs on its qbits
+            run = open_runs.pop(qbit, None)
+            if op != cz:
+                chain_ends.pop(qbit, None)
+            elif run is not None:
+                chain_ends[qbit] = run
+        new_ops.append(op)
+        new_qbits.append(qbit_pair)
+        fixed.append(True)
+
+    following = [-1] * len(runs)
+    for run, prev in enumerate(previous):
+        if prev >= 0:
+            following[prev] = run
+
+    order = []  # the runs chain after chain, each chain in order
+    for run, prev in enumerate(previous):
+        if prev < 0:  # walk each chain from its first run
+            while run >= 0:
+                order.append(run)
+                run = following[run]
+
+    gates = [index for run in runs for index in run]
+    alone = [ops[runs[run][0]] if len(runs[run]) == 1 else -1 for run in order]  # runs of a single gate
+    return {'gates': np.array(gates, dtype=np.int64),
+            'gate_strs': np.array([utils.gate_str_dict[ops[index]] for index in gates]),
+            'lengths': np.array([len(run) for run in runs], dtype=np.int64),
+            'order': np.array(order, dtype=np.int64),
+            'heads': np.array([previous[run] < 0 for run in order], dtype=bool),
+            'tails': np.array([following[run] < 0 for run in order], dtype=bool),
+            'slots': np.array([slots[run] for run in order], dtype=np.int64),
+            'firsts': np.array([runs[run][0] for run in order], dtype=np.int64),
+            'alone_rx': np.array(alone, dtype=np.int64) == rx, 'alone_rz': np.array(alone, dtype=np.int64) == rz,
+            'ops': np.array(new_ops, dtype=np.int8), 'qbits': np.array(new_qbits, dtype=np.int32).reshape(-1, 2),
+            'fixed': np.array(fixed, dtype=bool)}
+
+
+def _bind_fused(plan, angles, num_qbits):
+    """
+    Fuses the runs of a skeleton for a batch of bindings at once: the unitaries of all the runs
+    of every binding are multiplied together and their ZXZ angles (c, b, a) extracted in one go.
+    Along each chain, the trailing Rz(a) of a run is then merged into the leading Rz(c) of the next
+    run, or (if the next run is diagonal, b = 0) passed on through it. The angles passed along are
+    found with a cumulative sum which restarts at every run that is not diagonal.
+
+    :param plan: dict, see _fusion_plan
+    :param angles: 2d array of floats, shape (num_bindings, num_gates), the params of the skeleton
+    :param num_qbits: int
+    :return: list of GateIR's, one per binding
+    """
+
+    num_bindings, num_runs = len(angles), len(plan['order'])
+    if num_bindings == 0:
+        return []
+
+    matrices = qcomp._single_qbit_matrices(np.tile(plan['gate_strs'], num_bindings),
+                                           np.nan_to_num(angles[:, plan['gates']]).ravel())
+    products = qcomp._run_products(matrices.reshape(num_bindings, -1, 2, 2), plan['lengths'])[:, plan['order']]
+    a, b, c = (angle.reshape(num_bindings, num_runs) for angle in qcomp.euler_zxz(products.reshape(-1, 2, 2)))
+
+    # a run of a single Rx or Rz keeps its angle (euler_zxz would write eg. Rx(4) as Rz(pi) Rx(2pi - 4) Rz(pi))
+    alone_rx, alone_rz, firsts = plan['alone_rx'], plan['alone_rz'], angles[:, plan['firsts']]
+    a = np.where(alone_rx, 0.0, np.where(alone_rz, firsts, a))
+    b = np.where(alone_rx, firsts, np.where(alone_rz, 0.0, b))
+    c = np.where(alone_rx | alone_rz, 0.0, c)
+
+    turns = qcomp._nonzero_angles(b)  # the runs which are not diagonal
+    through = np.where(turns, a, c + a)  # what each run adds to the Rz it passes on
+
+    # the Rz passed on by a run is the sum of 'through' back to the last run which turns (or starts the chain)
+    restarts = np.where(turns | plan['heads'], np.arange(num_runs), 0)
+    sums = np.zeros((num_bindings, num_runs + 1))
+    np.cumsum(through, axis=1, out=sums[:, 1:])
+    passed = sums[:, 1:] - np.take_along_axis(sums, np.maximum.accumulate(restarts, axis=1), axis=1)
+    received = np.zeros_like(passed)
+    received[:, 1:] = passed[:, :-1]
+    received[:, plan['heads']] = 0
+
+    params = np.full((num_bindings, len(plan['ops'])), np.nan)
+    keep = np.tile(plan['fixed'], (num_bindings, 1))
+    slots = plan['slots']
+    params[:, slots] = c + received                    # the leading Rz, merged with the Rz passed on to it
+    keep[:, slots] = turns & qcomp._nonzero_angles(params[:, slots])
+    params[:, slots + 1] = b
+    keep[:, slots + 1] = turns
+    params[:, slots + 2] = passed                      # the trailing Rz, only written out at the end of a chain
+    keep[:, slots + 2] = plan['tails'] & qcomp._nonzero_angles(passed)
+
+    ops, qbits = plan['ops'], plan['qbits']
+    return [utils.GateIR(ops[kept], qbits[kept], row[kept], num_qbits) for row, kept in zip(params, keep)]
+
+
+def get_params(circ):
+    """
+    Returns the parameters of a circuit (the angles of its Rx, Ry and Rz gates, in order),
+    these are the values a CircuitTemplate of the circuit is bound with.
+
+    :param circ: qiskit.QuantumCircuit object (or a GateIR)
+    :return: array of floats
+    """
+
+    ir = circ if isinstance(circ, utils.GateIR) else utils.read_circ_ir(circ)
+    return ir.params[~np.isnan(ir.params)]